@@ -0,0 +1,151 @@
+import argparse
+import collections
+import itertools
+import json
+import multiprocessing
+import sys
+
+from chess_viz import ChessBoard, EMPTY_BOARD, INT_PIECE_FORMAT, Move, Piece, Player
+
+
+CHUNK_SIZE = 1024
+# pieces by INT_PIECE_FORMAT code, for positions given as encoding.py arrays
+CODE_PIECES = [Piece.Empty] * 13
+for _piece, _code in INT_PIECE_FORMAT.items():
+    CODE_PIECES[_code] = _piece
+
+
+class Analysis:
+
+    __slots__ = ("moves", "status", "white_attacks", "black_attacks", "error")
+
+    def __init__(self, moves, status, white_attacks, black_attacks, error=None):
+        self.moves = moves  # legal moves of the side to move, packed ints or coordinate notation
+        self.status = status  # "normal", "check", "checkmate", "stalemate" or "invalid"
+        self.white_attacks = white_attacks  # attackers of each square, by square i * 8 + j
+        self.black_attacks = black_attacks
+        self.error = error  # why an "invalid" position couldn't be loaded
+
+    @classmethod
+    def invalid(cls, error):
+        return cls([], "invalid", [], [], str(error))
+
+    def to_dict(self):
+        d = {"moves": self.moves, "status": self.status, "white_attacks": self.white_attacks,
+             "black_attacks": self.black_attacks}
+        if self.error is not None:
+            d["error"] = self.error
+        return d
+
+
+def load_position(chess_board: ChessBoard, position):
+    # a FEN string, or (board, turn) with an 8x8 list of Pieces or of INT_PIECE_FORMAT codes (encoding.board_array)
+    if isinstance(position, str):
+        chess_board.set_fen(position)
+        return chess_board
+    board, turn = position
+    if hasattr(board, "tolist"):
+        board = board.tolist()
+    if len(board) != 8 or any(len(row) != 8 for row in board):
+        raise ValueError("a board has 8 rows of 8 squares")
+    if not isinstance(board[0][0], Piece):
+        if any(not 0 <= c < len(CODE_PIECES) for row in board for c in row):
+            raise ValueError(f"piece codes go from 0 to {len(CODE_PIECES) - 1}")
+        board = [[CODE_PIECES[c] for c in row] for row in board]
+    if any(p in (Piece.WP, Piece.BP) for p in board[0] + board[7]):
+        raise ValueError("a pawn on the first or last rank")
+    chess_board.board = board
+    chess_board.turn = turn
+    chess_board.history = []
+    return chess_board
+
+
+def analyze_position(chess_board: ChessBoard, uci=False):
+    # the Analysis of the position loaded in chess_board
+    player = chess_board.turn
+    codes = chess_board.legal_moves(player)
+    checked = chess_board.is_checked(player)
+    if codes:
+        status = "check" if checked else "normal"
+    else:
+        status = "checkmate" if checked else "stalemate"
+    moves = [Move.from_code(c).uci() for c in codes] if uci else codes
+    return Analysis(moves, status, chess_board.attack_counts(Player.White), chess_board.attack_counts(Player.Black))
+
+
+def analyze_chunk(positions, uci=False, chess_board=None):
+    # one board is loaded with every position in turn. a position that can't be loaded or analysed gets an
+    # "invalid" Analysis and the chunk goes on
+    if chess_board is None:
+        chess_board = ChessBoard(EMPTY_BOARD)
+    results = []
+    for position in positions:
+        try:
+            results.append(analyze_position(load_position(chess_board, position), uci))
+        except (ValueError, IndexError, KeyError, TypeError) as e:
+            results.append(Analysis.invalid(e))
+    return results
+
+
+def _chunks(positions, size):
+    positions = iter(positions)
+    while True:
+        chunk = list(itertools.islice(positions, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# board of the current worker process, reused for every chunk it gets
+_worker_board = None
+
+
+def _init_worker():
+    global _worker_board
+    _worker_board = ChessBoard(EMPTY_BOARD)
+
+
+def _analyze_task(task):
+    chunk, uci = task
+    return analyze_chunk(chunk, uci, _worker_board)
+
+
+def analyze(positions, uci=False, chunk_size=CHUNK_SIZE, processes=1):
+    # yields the Analysis of every position of an iterable, in order. positions are read and analysed
+    # chunk_size at a time, so a stream of millions never has to fit in memory
+    if processes == 1:
+        chess_board = ChessBoard(EMPTY_BOARD)
+        for chunk in _chunks(positions, chunk_size):
+            yield from analyze_chunk(chunk, uci, chess_board)
+        return
+    # Pool.imap would read the whole input ahead, only a few chunks per worker are in flight here
+    with multiprocessing.Pool(processes, initializer=_init_worker) as pool:
+        pending = collections.deque()
+        for chunk in _chunks(positions, chunk_size):
+            pending.append(pool.apply_async(_analyze_task, ((chunk, uci),)))
+            if len(pending) > 2 * processes:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="legal moves, check status and attack counts of FEN positions, "
+                                                 "one FEN per input line, one JSON object per output line")
+    parser.add_argument("input", nargs="?", help="the FEN file, stdin by default")
+    parser.add_argument("-o", "--output", help="the JSON lines file, stdout by default")
+    parser.add_argument("-p", "--processes", type=int, default=1)
+    parser.add_argument("--chunk", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    source = open(args.input) if args.input else sys.stdin
+    out = open(args.output, "w") if args.output else sys.stdout
+    with source, out:
+        fens = (line.strip() for line in source if line.strip())
+        fens, copy = itertools.tee(fens)
+        for fen, analysis in zip(copy, analyze(fens, True, args.chunk, args.processes)):
+            out.write(json.dumps(dict(fen=fen, **analysis.to_dict())) + "\n")
+
+
+if __name__ == "__main__":
+    main()
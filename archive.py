@@ -0,0 +1,297 @@
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+import numpy as np
+
+from chess_viz import ChessBoard, Move, START_BOARD
+
+
+# games in two files. <path> holds one record per game: a RECORD header (result, plies, lengths), the start FEN
+# (empty for the standard start), the headers as JSON and the moves as little endian 16 bit packed ints.
+# <path>.idx holds a 16 byte INDEX entry per game (record offset and length, plies, result), so game N is one
+# seek and filtering by result reads only the index. both files start with a 16 byte magic and version
+DATA_MAGIC = b"CHESSARC"
+INDEX_MAGIC = b"CHESSIDX"
+VERSION = 2
+FILE_HEADER = struct.Struct("<8sH6x")
+RECORD = struct.Struct("<BxHII")  # result, plies, FEN bytes, header bytes
+MAX_PLIES = 0xFFFF  # plies are 16 bit in the record and the index
+MAX_RECORD = 0xFFFFFFFF  # record lengths are 32 bit in the index
+INDEX = np.dtype([("offset", "<u8"), ("length", "<u4"), ("plies", "<u2"), ("result", "u1"), ("flags", "u1")])
+RESULTS = ("*", "1-0", "0-1", "1/2-1/2")
+RESULT_CODES = {result: code for code, result in enumerate(RESULTS)}
+
+
+class ArchivedGame:
+
+    __slots__ = ("number", "result", "moves", "start_fen", "headers")
+
+    def __init__(self, number, result, moves, start_fen=None, headers=None):
+        self.number = number  # position in the archive, from 0
+        self.result = result
+        self.moves = moves  # array of packed moves
+        self.start_fen = start_fen  # None for the standard start
+        self.headers = headers if headers is not None else {}
+
+    def __len__(self):
+        return len(self.moves)
+
+    def start_board(self):
+        if self.start_fen:
+            return ChessBoard.from_fen(self.start_fen)
+        return ChessBoard(START_BOARD)
+
+    def play(self, chess_board=None):
+        # plays the game on chess_board (a fresh start board by default), yielding each move after it is played
+        if chess_board is None:
+            chess_board = self.start_board()
+        for code in self.moves:
+            move = Move.from_code(code)
+            chess_board.play_move(move)
+            yield move
+
+    def pgn(self):
+        # a pgn.PgnGame of the game
+        from pgn import game_from_moves
+
+        headers = dict(self.headers)
+        headers["Result"] = self.result
+        return game_from_moves(self.moves, self.start_board(), headers)
+
+
+class GameArchive:
+
+    # mode "r" reads through mmap, "a" also appends (creating the files). the files are mapped on first read
+    # and again after an append, so reads never load more than the records they touch
+    def __init__(self, path, mode="r"):
+        if mode not in ("r", "a"):
+            raise ValueError(f"bad mode: {mode}")
+        self.path = path
+        self.index_path = path + ".idx"
+        self.mode = mode
+        self.data_file = None
+        self.index_file = None
+        self.data_map = None
+        self.index_map = None
+        self.index = None  # INDEX entries, a view of index_map
+        self.count = 0
+        if mode == "a":
+            self._open_append()
+        else:
+            self._check(self.path, DATA_MAGIC)
+            self.count = self._indexed(self.index_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getstate__(self):
+        # a copy sent to another process maps the files again on first use, it can only read
+        state = self.__dict__.copy()
+        state.update(mode="r", data_file=None, index_file=None, data_map=None, index_map=None, index=None)
+        return state
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def _check(path, magic):
+        with open(path, "rb") as f:
+            header = f.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size or FILE_HEADER.unpack(header) != (magic, VERSION):
+            raise ValueError(f"{path} isn't a version {VERSION} game archive")
+
+    @staticmethod
+    def _indexed(index_path):
+        GameArchive._check(index_path, INDEX_MAGIC)
+        return (os.path.getsize(index_path) - FILE_HEADER.size) // INDEX.itemsize
+
+    def _open_append(self):
+        for path, magic in ((self.path, DATA_MAGIC), (self.index_path, INDEX_MAGIC)):
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                with open(path, "wb") as f:
+                    f.write(FILE_HEADER.pack(magic, VERSION))
+        self.count = self._indexed(self.index_path)
+        self._check(self.path, DATA_MAGIC)
+
+        # an append cut short leaves a partial index entry or a record without one, both are dropped
+        end = FILE_HEADER.size
+        if self.count:
+            end = int(self.entry(self.count - 1)["offset"]) + int(self.entry(self.count - 1)["length"])
+        self._unmap()
+        self.data_file = open(self.path, "r+b")
+        self.data_file.truncate(end)
+        self.data_file.seek(end)
+        self.index_file = open(self.index_path, "r+b")
+        self.index_file.truncate(FILE_HEADER.size + self.count * INDEX.itemsize)
+        self.index_file.seek(0, os.SEEK_END)
+
+    def _map(self):
+        # maps both files as they are now, records appended later need a new mapping
+        with open(self.path, "rb") as f:
+            self.data_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.count:
+            with open(self.index_path, "rb") as f:
+                self.index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.index = np.frombuffer(self.index_map, INDEX, self.count, FILE_HEADER.size)
+        else:
+            self.index = np.zeros(0, INDEX)
+
+    def _unmap(self):
+        # a map still viewed by an array handed out by entries() is closed once that array goes
+        self.index = None
+        for name in ("data_map", "index_map"):
+            if getattr(self, name) is not None:
+                try:
+                    getattr(self, name).close()
+                except BufferError:
+                    pass
+                setattr(self, name, None)
+
+    def close(self):
+        self._unmap()
+        for name in ("data_file", "index_file"):
+            if getattr(self, name) is not None:
+                getattr(self, name).close()
+                setattr(self, name, None)
+
+    def entries(self):
+        # the INDEX entries of every game, as a numpy structured array
+        if self.index is None:
+            self._map()
+        return self.index
+
+    def entry(self, number):
+        if not 0 <= number < self.count:
+            raise IndexError(f"no game {number}, the archive has {self.count}")
+        return self.entries()[number]
+
+    def __getitem__(self, number):
+        if number < 0:
+            number += self.count
+        entry = self.entry(number)
+        offset = int(entry["offset"])
+        result, plies, fen_length, headers_length = RECORD.unpack_from(self.data_map, offset)
+        offset += RECORD.size
+        start_fen = bytes(self.data_map[offset:offset + fen_length]).decode() or None
+        offset += fen_length
+        headers = json.loads(self.data_map[offset:offset + headers_length]) if headers_length else {}
+        offset += headers_length
+        moves = array("H")
+        moves.frombytes(self.data_map[offset:offset + 2 * plies])
+        if sys.byteorder == "big":
+            moves.byteswap()
+        return ArchivedGame(number, RESULTS[result], moves, start_fen, headers)
+
+    def __iter__(self):
+        for number in range(self.count):
+            yield self[number]
+
+    def numbers(self, result=None, min_plies=0, max_plies=None):
+        # the numbers of the games with that result and length, from the index alone
+        entries = self.entries()
+        mask = entries["plies"] >= min_plies
+        if result is not None:
+            mask &= entries["result"] == RESULT_CODES[result]
+        if max_plies is not None:
+            mask &= entries["plies"] <= max_plies
+        return np.flatnonzero(mask)
+
+    def games(self, numbers):
+        for number in numbers:
+            yield self[int(number)]
+
+    def append(self, moves, result="*", headers=None, start_fen=None):
+        # writes a game of packed moves (or Move objects) and returns its number. the record is flushed
+        # before its index entry, so a reader never sees an entry without its record
+        if self.mode != "a":
+            raise ValueError("the archive isn't open for appending")
+        if result not in RESULT_CODES:
+            raise ValueError(f"bad result: {result}")
+        moves = array("H", moves)
+        if len(moves) > MAX_PLIES:
+            raise ValueError(f"{len(moves)} plies, an archived game has at most {MAX_PLIES}")
+        if sys.byteorder == "big":
+            moves.byteswap()
+        fen = (start_fen or "").encode()
+        header_bytes = json.dumps(headers, separators=(",", ":")).encode() if headers else b""
+        if RECORD.size + len(fen) + len(header_bytes) + 2 * len(moves) > MAX_RECORD:
+            raise ValueError(f"the headers take {len(header_bytes)} bytes, a record has at most {MAX_RECORD}")
+        record = (RECORD.pack(RESULT_CODES[result], len(moves), len(fen), len(header_bytes)) + fen + header_bytes
+                  + moves.tobytes())
+
+        offset = self.data_file.tell()
+        self.data_file.write(record)
+        self.data_file.flush()
+        entry = np.zeros(1, INDEX)
+        entry[0] = (offset, len(record), len(moves), RESULT_CODES[result], 0)
+        self.index_file.write(entry.tobytes())
+        self.index_file.flush()
+        self._unmap()
+        self.count += 1
+        return self.count - 1
+
+    def append_pgn(self, game):
+        # a pgn.PgnGame
+        chess_board = game.start_board()
+        moves = list(game.play(chess_board))
+        headers = {k: v for k, v in game.headers.items() if k not in ("Result", "FEN", "SetUp")}
+        start_fen = game.headers.get("FEN")
+        return self.append(moves, game.result if game.result in RESULT_CODES else "*", headers, start_fen)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="game archives: import PGN, export PGN, count and show games")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("import", help="append the games of a PGN file to an archive")
+    add.add_argument("pgn")
+    add.add_argument("archive")
+    export = commands.add_parser("export", help="write games of an archive as PGN to stdout")
+    export.add_argument("archive")
+    export.add_argument("--result", choices=RESULTS)
+    info = commands.add_parser("info", help="game counts by result")
+    info.add_argument("archive")
+    show = commands.add_parser("show", help="the moves of game N, from 0")
+    show.add_argument("archive")
+    show.add_argument("number", type=int)
+    args = parser.parse_args()
+
+    if args.command == "import":
+        from pgn import read_games
+
+        with open(args.pgn) as f, GameArchive(args.archive, "a") as archive:
+            first = len(archive)
+            # a game with an illegal move or too long to archive is reported and skipped
+            for number, game in enumerate(read_games(f), 1):
+                try:
+                    archive.append_pgn(game)
+                except (ValueError, IndexError, KeyError) as e:
+                    print(f"game {number} skipped: {e}", file=sys.stderr)
+            print(f"{len(archive) - first} games imported, {len(archive)} in {args.archive}")
+        return
+
+    with GameArchive(args.archive) as archive:
+        if args.command == "export":
+            from pgn import write_games
+
+            write_games(sys.stdout, (game.pgn() for game in archive.games(archive.numbers(args.result))))
+        elif args.command == "info":
+            results = np.bincount(archive.entries()["result"], minlength=len(RESULTS))
+            print(f"{len(archive)} games, {int(archive.entries()['plies'].sum())} plies")
+            for result, n in zip(RESULTS, results):
+                print(f"{result}: {n}")
+        else:
+            game = archive[args.number]
+            print(f"{game.result} {game.headers}")
+            print(" ".join(move.uci() for move in game.play()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+from chess_viz import ChessBoard, Player, START_BOARD, bot
+from book import BookPlayer, EndgameTables, OpeningBook
+from engine import UciEngine
+from search import SearchPlayer
+
+
+MAX_PLIES = 400
+
+
+class GameResult:
+
+    def __init__(self, index, swapped, result, reason, moves):
+        self.index = index
+        self.swapped = swapped  # player b had white
+        self.result = result  # "1-0", "0-1" or "1/2-1/2"
+        self.reason = reason
+        self.moves = moves  # in coordinate notation
+
+    def __str__(self):
+        return f"game {self.index}: {self.result} ({self.reason}, {len(self.moves)} plies)"
+
+    def score_a(self):
+        # 1, 0.5 or 0 from player a's side
+        if self.result == "1/2-1/2":
+            return 0.5
+        return float((self.result == "1-0") != self.swapped)
+
+    def codes(self):
+        # the moves packed, replayed from the start position
+        chess_board = ChessBoard(START_BOARD)
+        codes = []
+        for uci in self.moves:
+            move = chess_board.move_from_uci(uci)
+            chess_board.play_move(move)
+            codes.append(move)
+        return codes
+
+
+def random_player(board, player: Player, time_limit=None):
+    if not isinstance(board, ChessBoard):
+        board = ChessBoard(board, player)
+    return random.choice(board.all_possible_move(player))
+
+
+class ScriptedPlayer:
+
+    # plays the given moves in order, then (or after an illegal one) random moves
+    def __init__(self, moves):
+        self.moves = moves
+        self.played = 0
+
+    def new_game(self):
+        self.played = 0
+
+    def __call__(self, board, player: Player, time_limit=None):
+        if not isinstance(board, ChessBoard):
+            board = ChessBoard(board, player)
+        if self.played < len(self.moves):
+            self.played += 1
+            try:
+                return board.move_from_uci(self.moves[self.played - 1])
+            except ValueError:
+                pass
+        return random_player(board, player)
+
+
+def make_player(spec):
+    # "random", "bot", "search", "search:<seconds per move>", "uci:<engine command>" or "script:e2e4,e7e5,..."
+    if spec == "random":
+        return random_player
+    if spec == "bot":
+        return bot
+    if spec == "search":
+        return SearchPlayer()
+    if spec.startswith("search:"):
+        return SearchPlayer(float(spec[7:]))
+    if spec.startswith("uci:"):
+        return UciEngine(spec[4:])
+    if spec.startswith("script:"):
+        return ScriptedPlayer(spec[7:].split(","))
+    raise ValueError(f"unknown player: {spec}")
+
+
+def play_game(white, black, start_board=START_BOARD, max_plies=MAX_PLIES):
+    # plays one game without a display, returns (result, reason, moves)
+    chess_board = ChessBoard(start_board)
+    players = {Player.White: white, Player.Black: black}
+    # a player that raises (an engine that won't start or died, a bot that crashed) loses the game
+    for player, player_fn in players.items():
+        new_game = getattr(player_fn, "new_game", None)
+        if new_game is not None:
+            try:
+                new_game()
+            except Exception:
+                return ("0-1" if player.is_white() else "1-0"), "player error", []
+
+    moves = []
+    while len(moves) < max_plies:
+        turn = chess_board.turn
+        legal = chess_board.all_possible_move(turn)
+        if not legal:
+            if chess_board.is_checked(turn):
+                return ("0-1" if turn.is_white() else "1-0"), "checkmate", moves
+            return "1/2-1/2", "stalemate", moves
+
+        # players get a copy of the real board, an 8x8 list would lose castling rights and en passant
+        try:
+            move = players[turn](ChessBoard.from_fen(chess_board.fen()), turn)
+        except Exception:
+            return ("0-1" if turn.is_white() else "1-0"), "player error", moves
+        # the move is matched against the legal moves, which also fills in castle / promotion types
+        try:
+            move = chess_board.move_from_uci(move.uci())
+        except (ValueError, AttributeError):
+            return ("0-1" if turn.is_white() else "1-0"), "illegal move", moves
+
+        chess_board.play_move(move)
+        moves.append(move.uci())
+        if chess_board.is_threefold_repetition():
+            return "1/2-1/2", "threefold repetition", moves
+
+    return "1/2-1/2", "move limit", moves
+
+
+# players of the current worker process, set up once so engines stay open between games
+_worker_players = None
+
+
+def _init_worker(player_a, player_b, seed, max_plies):
+    global _worker_players
+    _worker_players = (player_a, player_b, seed, max_plies)
+
+
+def _play_indexed(task):
+    index, swapped = task
+    player_a, player_b, seed, max_plies = _worker_players
+    random.seed(None if seed is None else seed + index)
+    white, black = (player_b, player_a) if swapped else (player_a, player_b)
+    result, reason, moves = play_game(white, black, max_plies=max_plies)
+    return GameResult(index, swapped, result, reason, moves)
+
+
+def run_games(player_a, player_b, games, processes=None, alternate=True, seed=None, max_plies=MAX_PLIES):
+    # plays the games on a process pool and yields a GameResult as each one finishes.
+    # players are pickled once per worker, so they must be top level functions or picklable objects
+    processes = processes or os.cpu_count() or 1
+    tasks = [(i, alternate and i % 2 == 1) for i in range(games)]
+
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(player_a, player_b, seed, max_plies)) as pool:
+        yield from pool.imap_unordered(_play_indexed, tasks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="play games between two players without a display")
+    parser.add_argument("player_a", help='"random", "bot", "search[:<seconds>]", "uci:<engine command>" or "script:e2e4,e7e5,..."')
+    parser.add_argument("player_b")
+    parser.add_argument("-n", "--games", type=int, default=100)
+    parser.add_argument("-p", "--processes", type=int, default=None, help="worker processes, defaults to the core count")
+    parser.add_argument("--no-alternate", action="store_true", help="player a always has white")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--max-plies", type=int, default=MAX_PLIES)
+    parser.add_argument("--book", help="opening book both players move from while in book")
+    parser.add_argument("--tables", help="directory of the endgame tables both players use")
+    parser.add_argument("--archive", help="game archive (see archive.py) every game is appended to")
+    args = parser.parse_args()
+
+    player_a, player_b = make_player(args.player_a), make_player(args.player_b)
+    if args.book or args.tables:
+        book = OpeningBook(args.book) if args.book else None
+        tables = EndgameTables(args.tables) if args.tables else None
+        player_a, player_b = BookPlayer(player_a, book, tables), BookPlayer(player_b, book, tables)
+
+    archive = None
+    if args.archive:
+        from archive import GameArchive  # needs numpy, which batch runs don't otherwise
+
+        archive = GameArchive(args.archive, "a")
+    wins, draws, losses = 0, 0, 0
+    start = time.perf_counter()
+    for game in run_games(player_a, player_b, args.games, args.processes, not args.no_alternate, args.seed,
+                          args.max_plies):
+        score = game.score_a()
+        wins += score == 1
+        draws += score == 0.5
+        losses += score == 0
+        print(f"{game}  a: +{wins} ={draws} -{losses}", flush=True)
+        if archive is not None:
+            white, black = (args.player_b, args.player_a) if game.swapped else (args.player_a, args.player_b)
+            archive.append(game.codes(), game.result, {"White": white, "Black": black, "Termination": game.reason})
+    if archive is not None:
+        archive.close()
+
+    played = wins + draws + losses
+    elapsed = time.perf_counter() - start
+    print(f"{args.player_a} vs {args.player_b}: +{wins} ={draws} -{losses}, "
+          f"score {(wins + draws / 2) / max(played, 1):.3f}, {played / elapsed:.1f} games/s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,375 @@
+import argparse
+import mmap
+import os
+import random
+import struct
+
+from chess_viz import (CASTLES, CASTLE_MOVE_TYPES, ChessBoard, FULL_BOARD, KING_ATTACKS, Move, MoveType, PLAYER_PIECES,
+                       Player, START_BOARD, ZOBRIST_EN_PASSANT, bishop_attacks, bits, rook_attacks, takes_time_limit)
+
+
+# a book entry: key, move, weight, learn, big-endian. the entries follow Polyglot's layout but the keys are
+# book_key hashes, not Polyglot's Random64 ones, so the file starts with a header of one entry's size that
+# tells it apart from a Polyglot .bin book
+ENTRY = struct.Struct(">QHHI")
+KEY = struct.Struct(">Q")
+BOOK_HEADER = struct.Struct(">8sH6x")
+BOOK_MAGIC = b"CHESSBOK"
+BOOK_VERSION = 1
+POLYGLOT_PROMOTIONS = {MoveType.PromotionKnight.value: 1, MoveType.PromotionBishop.value: 2,
+                       MoveType.PromotionRook.value: 3, MoveType.PromotionQueen.value: 4}
+# Polyglot writes castling as the king taking its own rook
+CASTLE_ROOKS = {(rule.king_src, rule.king_dst): rule.rook_src for rule in CASTLES.values()}
+
+# endgame tables by material, with the index of the strong side's extra piece in PLAYER_PIECES
+TABLES = {"KQK": 4, "KRK": 3}
+TABLE_SIZE = 1 << 19  # side to move, strong king, piece, weak king
+
+
+def book_key(chess_board: ChessBoard):
+    # the position hash without the en passant square, which a board rebuilt from an 8x8 list doesn't know
+    if chess_board.en_passant is None:
+        return chess_board.hash
+    return chess_board.hash ^ ZOBRIST_EN_PASSANT[chess_board.en_passant & 7]
+
+
+def encode_move(code):
+    # a packed move in Polyglot's to | from << 6 | promotion << 12 layout
+    src, dst, t = code & 63, code >> 6 & 63, code >> 12
+    if t in CASTLE_MOVE_TYPES:
+        dst = CASTLE_ROOKS[src, dst]
+    return dst | src << 6 | POLYGLOT_PROMOTIONS.get(t, 0) << 12
+
+
+class OpeningBook:
+
+    # a book written by build_book: 16 byte entries sorted by key after the header, read through mmap and
+    # searched by bisection, so the file is never loaded into memory
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.map = None
+        self.size = 0
+        self._open()  # a file that isn't a book is refused here, not at the first lookup
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getstate__(self):
+        # a copy sent to another process maps the file again on first use
+        state = self.__dict__.copy()
+        state["file"] = None
+        state["map"] = None
+        return state
+
+    def _open(self):
+        self.file = open(self.path, "rb")
+        header = self.file.read(BOOK_HEADER.size)
+        if len(header) < BOOK_HEADER.size or BOOK_HEADER.unpack(header) != (BOOK_MAGIC, BOOK_VERSION):
+            self.close()
+            raise ValueError(f"{self.path} isn't a version {BOOK_VERSION} book of build_book, "
+                             f"Polyglot .bin books aren't supported")
+        self.size = os.fstat(self.file.fileno()).st_size // ENTRY.size - 1
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def entries(self, key):
+        # (encode_move move, weight) of every entry of the position key
+        if self.file is None:
+            self._open()
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if KEY.unpack_from(self.map, (mid + 1) * ENTRY.size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        res = []
+        while lo < self.size:
+            k, move, weight, _ = ENTRY.unpack_from(self.map, (lo + 1) * ENTRY.size)
+            if k != key:
+                break
+            res.append((move, weight))
+            lo += 1
+        return res
+
+    def move(self, chess_board: ChessBoard, weighted_random=True):
+        # a book move of the side to move, picked by weight, or None out of book
+        entries = self.entries(book_key(chess_board))
+        if not entries:
+            return None
+        legal = {encode_move(c): c for c in chess_board.legal_moves(chess_board.turn)}
+        entries = [(legal[m], w) for m, w in entries if m in legal and w]
+        if not entries:
+            return None
+        if weighted_random:
+            code = random.choices([c for c, _ in entries], weights=[w for _, w in entries])[0]
+        else:
+            code = max(entries, key=lambda e: e[1])[0]
+        return Move.from_code(code)
+
+
+def build_book(games, path, max_plies=20):
+    # writes a book of the first max_plies moves of PgnGames, a move weighs 2 per win and 1 per draw or unknown result
+    from pgn import parse_san
+
+    weights = {}
+    for game in games:
+        points = {"1-0": (2, 0), "0-1": (0, 2)}.get(game.result, (1, 1))
+        chess_board = game.start_board()
+        for san in game.moves[:max_plies]:
+            try:
+                move = parse_san(chess_board, san)
+            except ValueError:
+                break
+            weight = points[0] if chess_board.turn.is_white() else points[1]
+            entry = (book_key(chess_board), encode_move(move))
+            weights[entry] = weights.get(entry, 0) + weight
+            chess_board.play_move(move)
+
+    with open(path, "wb") as file:
+        file.write(BOOK_HEADER.pack(BOOK_MAGIC, BOOK_VERSION))
+        for (key, move), weight in sorted(weights.items()):
+            if weight:
+                file.write(ENTRY.pack(key, move, min(weight, 0xFFFF), 0))
+    return len(weights)
+
+
+def _piece_attacks(piece, sq, occ):
+    if piece == 4:
+        return bishop_attacks(sq, occ) | rook_attacks(sq, occ)
+    return rook_attacks(sq, occ)
+
+
+def generate_table(name):
+    # retrograde analysis of king + queen / rook against king. the index is
+    # weak_to_move << 18 | strong king << 12 | piece << 6 | weak king, with white as the strong side,
+    # the value is the distance to mate in plies + 1, 0 for draws and illegal positions
+    piece = TABLES[name]
+    values = bytearray(TABLE_SIZE)
+    moves_left = [0] * (1 << 18)  # weak to move: king moves not yet known to lose
+
+    frontier = []
+    for sk in range(64):
+        for p in range(64):
+            if p == sk:
+                continue
+            # the weak king doesn't block the lines it stands on
+            guarded = KING_ATTACKS[sk] | _piece_attacks(piece, p, 1 << sk)
+            for wk in bits(FULL_BOARD & ~KING_ATTACKS[sk] & ~(1 << sk | 1 << p)):
+                i = sk << 12 | p << 6 | wk
+                moves = bin(KING_ATTACKS[wk] & ~guarded).count("1")
+                moves_left[i] = moves
+                if not moves and guarded >> wk & 1:
+                    values[1 << 18 | i] = 1
+                    frontier.append(1 << 18 | i)
+
+    ply = 0
+    while frontier:
+        next_frontier = []
+        for index in frontier:
+            sk, p, wk = index >> 12 & 63, index >> 6 & 63, index & 63
+            if index >> 18:
+                # weak to move and lost: every strong move into it wins, if the weak king wasn't in check before
+                for x in bits(KING_ATTACKS[sk] & ~KING_ATTACKS[wk] & ~(1 << p | 1 << wk)):
+                    i = x << 12 | p << 6 | wk
+                    if not values[i] and not _piece_attacks(piece, p, 1 << x) >> wk & 1:
+                        values[i] = ply + 2
+                        next_frontier.append(i)
+                for y in bits(_piece_attacks(piece, p, 1 << sk | 1 << wk) & ~(1 << sk | 1 << wk)):
+                    i = sk << 12 | y << 6 | wk
+                    if not values[i] and not _piece_attacks(piece, y, 1 << sk) >> wk & 1:
+                        values[i] = ply + 2
+                        next_frontier.append(i)
+            else:
+                # strong to move and winning: a weak position is lost once all its moves lead to such positions
+                for z in bits(KING_ATTACKS[wk] & ~KING_ATTACKS[sk] & ~(1 << sk | 1 << p)):
+                    i = sk << 12 | p << 6 | z
+                    if values[1 << 18 | i]:
+                        continue
+                    moves_left[i] -= 1
+                    if not moves_left[i]:
+                        values[1 << 18 | i] = ply + 2
+                        next_frontier.append(1 << 18 | i)
+        frontier = next_frontier
+        ply += 1
+    return values
+
+
+def generate_tables(directory, names=tuple(TABLES)):
+    # writes the missing <name>.egtb files of directory
+    os.makedirs(directory, exist_ok=True)
+    for name in names:
+        path = os.path.join(directory, name + ".egtb")
+        if not os.path.exists(path):
+            with open(path, "wb") as file:
+                file.write(generate_table(name))
+
+
+class EndgameTables:
+
+    # the tables of generate_tables, one file per material, read through mmap at the position's index
+    def __init__(self, directory):
+        self.directory = directory
+        self.maps = None  # mmap by material name, for the tables found in directory
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["maps"] = None
+        return state
+
+    def _open(self):
+        self.maps = {}
+        for name in TABLES:
+            path = os.path.join(self.directory, name + ".egtb")
+            if os.path.exists(path):
+                with open(path, "rb") as file:
+                    self.maps[name] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.maps is not None:
+            for m in self.maps.values():
+                m.close()
+            self.maps = None
+
+    def probe(self, chess_board: ChessBoard):
+        # (result, plies to mate) for the side to move, result 1, 0 or -1, or None for material without a table
+        if self.maps is None:
+            self._open()
+        occ = chess_board.occupancy[0] | chess_board.occupancy[1]
+        if bin(occ).count("1") != 3:
+            return None
+        found = [(player, name, chess_board.bitboards[PLAYER_PIECES[player][piece].value])
+                 for player in Player for name, piece in TABLES.items() if name in self.maps]
+        found = [f for f in found if f[2]]
+        kings = [chess_board.bitboards[PLAYER_PIECES[player][5].value] for player in Player]
+        if len(found) != 1 or not all(kings):
+            return None
+        strong, name, bb = found[0]
+
+        # a black strong side is mirrored onto white
+        flip = 0 if strong.is_white() else 56
+        sk = (kings[strong.value].bit_length() - 1) ^ flip
+        p = (bb.bit_length() - 1) ^ flip
+        wk = (kings[strong.oponent().value].bit_length() - 1) ^ flip
+        weak_to_move = chess_board.turn != strong
+        value = self.maps[name][weak_to_move << 18 | sk << 12 | p << 6 | wk]
+        if not value:
+            return 0, 0
+        return (-1 if weak_to_move else 1), value - 1
+
+    def move(self, chess_board: ChessBoard):
+        # the fastest mate, or the longest defence, or None for material without a table
+        if self.probe(chess_board) is None:
+            return None
+        best, best_score = None, None
+        for code in chess_board.legal_moves(chess_board.turn):
+            chess_board.play_move(code)
+            found = self.probe(chess_board)
+            chess_board.reverse_move()
+            # the reply position is seen from the opponent, a capture leaves no table and a draw
+            result, plies = found if found is not None else (0, 0)
+            score = -result * (1000 - plies)
+            if best_score is None or score > best_score:
+                best, best_score = code, score
+        return None if best is None else Move.from_code(best)
+
+
+class BookPlayer:
+
+    # answers from the opening book or the endgame tables when they know the position, asks player_fn otherwise
+    def __init__(self, player_fn, book: OpeningBook = None, tables: EndgameTables = None):
+        self.player_fn = player_fn
+        self.book = book
+        self.tables = tables
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, board, player: Player, time_limit=None):
+        chess_board = board if isinstance(board, ChessBoard) else ChessBoard(board, player)
+        move = self.lookup(chess_board)
+        if move is not None:
+            self.hits += 1
+            return move
+        self.misses += 1
+        kwargs = {"time_limit": time_limit} if time_limit is not None and takes_time_limit(self.player_fn) else {}
+        return self.player_fn(board, player, **kwargs)
+
+    def lookup(self, chess_board: ChessBoard):
+        move = None
+        if self.book is not None:
+            move = self.book.move(chess_board)
+        if move is None and self.tables is not None:
+            move = self.tables.move(chess_board)
+        return move
+
+    def stop(self):
+        stop = getattr(self.player_fn, "stop", None)
+        if stop is not None:
+            stop()
+
+    def new_game(self):
+        new_game = getattr(self.player_fn, "new_game", None)
+        if new_game is not None:
+            new_game()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build and query the opening book and the endgame tables")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build-book", help="build a book from PGN files")
+    build.add_argument("book")
+    build.add_argument("pgn", nargs="+")
+    build.add_argument("--plies", type=int, default=20)
+    tables = commands.add_parser("build-tables", help="generate the KQK and KRK tables")
+    tables.add_argument("directory")
+    probe = commands.add_parser("probe", help="look a position up")
+    probe.add_argument("--fen")
+    probe.add_argument("--book")
+    probe.add_argument("--tables")
+    args = parser.parse_args()
+
+    if args.command == "build-book":
+        from pgn import read_games
+
+        def games():
+            for path in args.pgn:
+                with open(path) as file:
+                    yield from read_games(file)
+
+        print(f"{build_book(games(), args.book, args.plies)} entries")
+    elif args.command == "build-tables":
+        generate_tables(args.directory)
+    else:
+        chess_board = ChessBoard(START_BOARD) if args.fen is None else ChessBoard.from_fen(args.fen)
+        if args.book:
+            with OpeningBook(args.book) as book:
+                for code, weight in sorted(((m, w) for m, w in book.entries(book_key(chess_board))), key=lambda e: -e[1]):
+                    print(f"book {code:04x} weight {weight}")
+                move = book.move(chess_board, weighted_random=False)
+                print(f"book move: {move.uci() if move else None}")
+        if args.tables:
+            with EndgameTables(args.tables) as endgame:
+                move = endgame.move(chess_board)
+                print(f"tables: {endgame.probe(chess_board)}, move: {move.uci() if move else None}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
 from enum import Enum
 import pygame
 from itertools import product
+from collections import OrderedDict
+import os
+import random
+import inspect
 import subprocess
-from copy import deepcopy
+import threading
+import time
 
 
 BOT_EXE = "bot"
@@ -19,6 +24,12 @@ BLACK_POSSIBLE_MOVE_COLOR = WHITE_POSSIBLE_MOVE_COLOR
 
 SCREEN_SIZE = (600, 600)
 SQUARE_SIZE = SCREEN_SIZE[0] // 8
+FPS = 60
+
+OVERLAY_INTERVAL = 0.25  # seconds between refreshes of the instruments overlay
+OVERLAY_COLOR = (0, 0, 0, 180)
+OVERLAY_TEXT_COLOR = (255, 255, 255)
+OVERLAY_FONT_SIZE = 18
 
 POSSIBLE_MOVE_CIRCLE_RADIUS_EMPTY = SQUARE_SIZE // 6
 POSSIBLE_MOVE_CIRCLE_RADIUS_NON_EMPTY = SQUARE_SIZE // 2 - 5
@@ -42,7 +53,7 @@ class Piece(Enum):
     def player(self):
         if self == Piece.Empty:
             return None
-        return Player.Black if self in [Piece.BP, Piece.BN, Piece.BB, Piece.BR, Piece.BQ, Piece.BK] else Player.White 
+        return Player.Black if self.value < 6 else Player.White
 
     def is_empty(self):
         return self == Piece.Empty
@@ -66,6 +77,8 @@ class MoveType(Enum):
     PromotionQueen = 3
     PromotionKnight = 4
     EnPassant = 5
+    PromotionRook = 6
+    PromotionBishop = 7
 
     def __str__(self):
         if self == MoveType.Normal:
@@ -80,6 +93,10 @@ class MoveType(Enum):
             return "queen promotion"
         elif self == MoveType.EnPassant:
             return "en passant"
+        elif self == MoveType.PromotionRook:
+            return "rook promotion"
+        elif self == MoveType.PromotionBishop:
+            return "bishop promotion"
 
 
 INT_PIECE_FORMAT = {
@@ -99,27 +116,61 @@ INT_PIECE_FORMAT = {
 }
 
 
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
+THEMES = ["light", "modern"]
 PIECE_TYPE = "light"
-PIECE_IMG = {
-    Piece.BP: pygame.image.load("images/" + PIECE_TYPE + "/bp.png"),
-    Piece.BN: pygame.image.load("images/" + PIECE_TYPE + "/bn.png"),
-    Piece.BB: pygame.image.load("images/" + PIECE_TYPE + "/bb.png"),
-    Piece.BR: pygame.image.load("images/" + PIECE_TYPE + "/br.png"),
-    Piece.BQ: pygame.image.load("images/" + PIECE_TYPE + "/bq.png"),
-    Piece.BK: pygame.image.load("images/" + PIECE_TYPE + "/bk.png"),
-    Piece.WP: pygame.image.load("images/" + PIECE_TYPE + "/wp.png"),
-    Piece.WN: pygame.image.load("images/" + PIECE_TYPE + "/wn.png"),
-    Piece.WB: pygame.image.load("images/" + PIECE_TYPE + "/wb.png"),
-    Piece.WR: pygame.image.load("images/" + PIECE_TYPE + "/wr.png"),
-    Piece.WQ: pygame.image.load("images/" + PIECE_TYPE + "/wq.png"),
-    Piece.WK: pygame.image.load("images/" + PIECE_TYPE + "/wk.png"),
+PIECE_FILES = {
+    Piece.BP: "bp.png",
+    Piece.BN: "bn.png",
+    Piece.BB: "bb.png",
+    Piece.BR: "br.png",
+    Piece.BQ: "bq.png",
+    Piece.BK: "bk.png",
+    Piece.WP: "wp.png",
+    Piece.WN: "wn.png",
+    Piece.WB: "wb.png",
+    Piece.WR: "wr.png",
+    Piece.WQ: "wq.png",
+    Piece.WK: "wk.png",
 }
 
 
-for p in PIECE_IMG:
-    PIECE_IMG[p] = pygame.transform.scale(PIECE_IMG[p], (SQUARE_SIZE, SQUARE_SIZE))
+class SpriteCache:
+
+    # piece images are read from disk on first use, once per theme, and scaled once per (theme, size)
+    def __init__(self, directory=IMAGES_DIR):
+        self.directory = directory
+        self.images = {}  # (theme, piece) -> surface as loaded
+        self.scaled = {}  # (theme, size) -> {piece: surface}
+
+    def image(self, theme, piece: Piece):
+        key = (theme, piece)
+        if key not in self.images:
+            self.images[key] = pygame.image.load(os.path.join(self.directory, theme, PIECE_FILES[piece]))
+        return self.images[key]
+
+    def sprites(self, theme=PIECE_TYPE, size=SQUARE_SIZE):
+        key = (theme, size)
+        if key not in self.scaled:
+            # converting to the display format needs a display, headless surfaces are kept as they are
+            convert = pygame.display.get_init() and pygame.display.get_surface() is not None
+            sprites = {}
+            for piece in PIECE_FILES:
+                sprite = pygame.transform.scale(self.image(theme, piece), (size, size))
+                sprites[piece] = sprite.convert_alpha() if convert else sprite
+            self.scaled[key] = sprites
+        return self.scaled[key]
+
+    def clear(self):
+        self.images.clear()
+        self.scaled.clear()
+
+
+PIECE_SPRITES = SpriteCache()
 
 
+EMPTY_BOARD = [[Piece.Empty] * 8 for _ in range(8)]
+
 START_BOARD = [
     [Piece.WR, Piece.WN, Piece.WB, Piece.WQ, Piece.WK, Piece.WB, Piece.WN, Piece.WR],
     [Piece.WP] * 8,
@@ -132,20 +183,23 @@ START_BOARD = [
 ]
 
 
+# codes of the board seen by black: every piece takes the code of the same piece of the other colour
+FLIPPED_INT_PIECE_FORMAT = {p: (c + 6 if c < 7 else c - 6) if c else 0 for p, c in INT_PIECE_FORMAT.items()}
+# the two digit cells of the bot command line, by code
+BOT_CELLS = [str(c).zfill(2) for c in range(13)]
+
+
 def transform_board(board, player: Player):
     if player.is_white():
         return [[INT_PIECE_FORMAT[p] for p in r] for r in board]
     else:
-        res = [[INT_PIECE_FORMAT[p] for p in r] for r in board[::-1]]
-        for i, j in product(range(8), repeat=2):
-            a = res[i][j]
-            if a != 0:
-                res[i][j] = a + 6 if a < 7 else a - 6
-        return res
+        return [[FLIPPED_INT_PIECE_FORMAT[p] for p in r] for r in board[::-1]]
 
 
 class Vec2:
 
+    __slots__ = ("i", "j")
+
     def __init__(self, i, j):
         self.i = i
         self.j = j
@@ -157,13 +211,13 @@ class Vec2:
         return Vec2(self.i + other.i, self.j + other.j)
     
     def __eq__(self, value):
-        return self.i == value.i and self.j == value.j
-    
+        return isinstance(value, Vec2) and self.i == value.i and self.j == value.j
+
     def __hash__(self):
-        return hash(self.i) + hash(self.j)
+        return self.i * 8 + self.j
 
     def is_legal(self):
-        return abs(self.i - 3.5) < 4 and abs(self.j - 3.5) < 4  # ya, thats bad coding
+        return 0 <= self.i < 8 and 0 <= self.j < 8
 
 
 VERTICAL_DIRECTIONS = [Vec2(1, 0), Vec2(0, 1), Vec2(-1, 0), Vec2(0, -1)]
@@ -171,333 +225,919 @@ DIAGONAL_DIRECTIONS = [Vec2(1, 1), Vec2(-1, 1), Vec2(1, -1), Vec2(-1, -1)]
 KNIGHT_DIRECTIONS = [Vec2(2, 1), Vec2(2, -1), Vec2(-2, 1), Vec2(-2, -1), Vec2(1, 2), Vec2(1, -2), Vec2(-1, 2), Vec2(-1, -2)]
 ALL_POS = [Vec2(i, j) for i, j in product(range(8), repeat=2)]
 
-CASTLE_WHITE_RIGHT = {
-    Vec2(0, 7): Piece.Empty,
-    Vec2(0, 6): Piece.WK,
-    Vec2(0, 5): Piece.WR,
-    Vec2(0, 4): Piece.Empty,
+# bitboards: bit (i * 8 + j) is the square Vec2(i, j), so ALL_POS[sq] is the Vec2 of square sq
+def square(pos: Vec2):
+    return pos.i * 8 + pos.j
+
+
+def bits(bb):
+    while bb:
+        b = bb & -bb
+        yield b.bit_length() - 1
+        bb ^= b
+
+
+def _step_attacks(directions):
+    table = []
+    for pos in ALL_POS:
+        bb = 0
+        for d in directions:
+            p = pos + d
+            if p.is_legal():
+                bb |= 1 << square(p)
+        table.append(bb)
+    return table
+
+
+def _rays(d):
+    table = []
+    for pos in ALL_POS:
+        bb = 0
+        p = pos + d
+        while p.is_legal():
+            bb |= 1 << square(p)
+            p = p + d
+        table.append(bb)
+    # rays towards higher squares are cut at their lowest blocker, the others at their highest
+    return table, d.i * 8 + d.j > 0
+
+
+KNIGHT_ATTACKS = _step_attacks(KNIGHT_DIRECTIONS)
+KING_ATTACKS = _step_attacks(VERTICAL_DIRECTIONS + DIAGONAL_DIRECTIONS)
+PAWN_ATTACKS = [_step_attacks([Vec2(-1, 1), Vec2(-1, -1)]), _step_attacks([Vec2(1, 1), Vec2(1, -1)])]  # by Player.value
+
+ROOK_RAYS = [_rays(d) for d in VERTICAL_DIRECTIONS]
+BISHOP_RAYS = [_rays(d) for d in DIAGONAL_DIRECTIONS]
+
+
+def _relevant_mask(sq, rays):
+    # the last square of a ray never blocks anything behind it, so it is left out of the lookup key
+    mask = 0
+    for ray, positive in rays:
+        r = ray[sq]
+        if r:
+            last = r.bit_length() - 1 if positive else (r & -r).bit_length() - 1
+            mask |= r ^ (1 << last)
+    return mask
+
+
+def _slide(sq, occ, rays):
+    attacks = 0
+    for ray, positive in rays:
+        r = ray[sq]
+        blockers = r & occ
+        if blockers:
+            b = (blockers & -blockers).bit_length() - 1 if positive else blockers.bit_length() - 1
+            r ^= ray[b]
+        attacks |= r
+    return attacks
+
+
+ROOK_MASKS = [_relevant_mask(sq, ROOK_RAYS) for sq in range(64)]
+BISHOP_MASKS = [_relevant_mask(sq, BISHOP_RAYS) for sq in range(64)]
+
+# sliding attacks are looked up by (square, relevant occupancy) and filled in on first use
+ROOK_TABLE = [{} for _ in range(64)]
+BISHOP_TABLE = [{} for _ in range(64)]
+
+
+def rook_attacks(sq, occ):
+    key = occ & ROOK_MASKS[sq]
+    table = ROOK_TABLE[sq]
+    attacks = table.get(key)
+    if attacks is None:
+        attacks = table[key] = _slide(sq, key, ROOK_RAYS)
+    return attacks
+
+
+def bishop_attacks(sq, occ):
+    key = occ & BISHOP_MASKS[sq]
+    table = BISHOP_TABLE[sq]
+    attacks = table.get(key)
+    if attacks is None:
+        attacks = table[key] = _slide(sq, key, BISHOP_RAYS)
+    return attacks
+
+
+FULL_BOARD = (1 << 64) - 1
+ROOK_LINES = [rook_attacks(sq, 0) for sq in range(64)]
+BISHOP_LINES = [bishop_attacks(sq, 0) for sq in range(64)]
+
+# squares strictly between two squares on a common line, 0 when they are not aligned
+BETWEEN = [[0] * 64 for _ in range(64)]
+for ray, _ in ROOK_RAYS + BISHOP_RAYS:
+    for a in range(64):
+        for b in bits(ray[a]):
+            BETWEEN[a][b] = ray[a] & ~ray[b] & ~(1 << b)
+
+
+# pieces of a player in the order: pawn, knight, bishop, rook, queen, king
+PLAYER_PIECES = {
+    Player.White: (Piece.WP, Piece.WN, Piece.WB, Piece.WR, Piece.WQ, Piece.WK),
+    Player.Black: (Piece.BP, Piece.BN, Piece.BB, Piece.BR, Piece.BQ, Piece.BK),
 }
-CASTLE_WHITE_LEFT = {
-    Vec2(0, 4): Piece.Empty,
-    Vec2(0, 3): Piece.WR,
-    Vec2(0, 2): Piece.WK,
-    Vec2(0, 1): Piece.Empty,
-    Vec2(0, 0): Piece.Empty,
+
+# Piece.value and Player.value of every piece, looked up without going through the enum
+PIECE_INDEX = {p: p.value for p in Piece if p != Piece.Empty}
+PIECE_SIDE = {p: p.player().value for p in Piece if p != Piece.Empty}
+
+PROMOTION_PIECES = {
+    (MoveType.PromotionQueen, Player.White): Piece.WQ,
+    (MoveType.PromotionKnight, Player.White): Piece.WN,
+    (MoveType.PromotionRook, Player.White): Piece.WR,
+    (MoveType.PromotionBishop, Player.White): Piece.WB,
+    (MoveType.PromotionQueen, Player.Black): Piece.BQ,
+    (MoveType.PromotionKnight, Player.Black): Piece.BN,
+    (MoveType.PromotionRook, Player.Black): Piece.BR,
+    (MoveType.PromotionBishop, Player.Black): Piece.BB,
 }
-CASTLE_BLACK_LEFT = {
-    Vec2(7, 7): Piece.Empty,
-    Vec2(7, 6): Piece.BK,
-    Vec2(7, 5): Piece.BR,
-    Vec2(7, 4): Piece.Empty,
+PROMOTION_TYPES = [MoveType.PromotionQueen, MoveType.PromotionKnight, MoveType.PromotionRook, MoveType.PromotionBishop]
+
+# MoveType.value as stored in packed moves, compared as plain ints on the hot paths
+MOVE_TYPES = sorted(MoveType, key=lambda t: t.value)
+CASTLE_MOVE_TYPES = (MoveType.CastleLeft.value, MoveType.CastleRight.value)
+PROMOTION_MOVE_TYPES = tuple(t.value for t in PROMOTION_TYPES)
+PROMOTION_CODES = [t.value << 12 for t in PROMOTION_TYPES]
+EN_PASSANT_MOVE = MoveType.EnPassant.value
+
+# castling rights bits
+WHITE_LEFT_CASTLE = 1
+WHITE_RIGHT_CASTLE = 2
+BLACK_LEFT_CASTLE = 4
+BLACK_RIGHT_CASTLE = 8
+
+
+class CastleRule:
+
+    def __init__(self, right, king_src, king_dst, rook_src, rook_dst, empty, safe):
+        self.right = right
+        self.king_src = king_src
+        self.king_dst = king_dst
+        self.rook_src = rook_src
+        self.rook_dst = rook_dst
+        self.empty = sum(1 << sq for sq in empty)
+        self.safe = safe  # squares the king stands on or crosses
+
+
+# "left" and "right" are seen from the player's side of the board
+CASTLES = {
+    (Player.White, MoveType.CastleLeft): CastleRule(WHITE_LEFT_CASTLE, 4, 2, 0, 3, [1, 2, 3], [4, 3, 2]),
+    (Player.White, MoveType.CastleRight): CastleRule(WHITE_RIGHT_CASTLE, 4, 6, 7, 5, [5, 6], [4, 5, 6]),
+    (Player.Black, MoveType.CastleLeft): CastleRule(BLACK_LEFT_CASTLE, 60, 62, 63, 61, [61, 62], [60, 61, 62]),
+    (Player.Black, MoveType.CastleRight): CastleRule(BLACK_RIGHT_CASTLE, 60, 58, 56, 59, [57, 58, 59], [60, 59, 58]),
 }
-CASTLE_BLACK_RIGHT = {
-    Vec2(7, 4): Piece.Empty,
-    Vec2(7, 3): Piece.BR,
-    Vec2(7, 2): Piece.BK,
-    Vec2(7, 1): Piece.Empty,
-    Vec2(7, 0): Piece.Empty,
+
+# castling rights that survive a move touching the square
+CASTLING_MASKS = [15] * 64
+for rule in CASTLES.values():
+    CASTLING_MASKS[rule.king_src] &= ~rule.right
+    CASTLING_MASKS[rule.rook_src] &= ~rule.right
+
+FEN_PIECES = {
+    "p": Piece.BP, "n": Piece.BN, "b": Piece.BB, "r": Piece.BR, "q": Piece.BQ, "k": Piece.BK,
+    "P": Piece.WP, "N": Piece.WN, "B": Piece.WB, "R": Piece.WR, "Q": Piece.WQ, "K": Piece.WK,
+}
+PIECE_FEN = {p: c for c, p in FEN_PIECES.items()}
+FEN_CASTLES = {"K": WHITE_RIGHT_CASTLE, "Q": WHITE_LEFT_CASTLE, "k": BLACK_LEFT_CASTLE, "q": BLACK_RIGHT_CASTLE}
+UCI_PROMOTIONS = {
+    MoveType.PromotionQueen: "q",
+    MoveType.PromotionKnight: "n",
+    MoveType.PromotionRook: "r",
+    MoveType.PromotionBishop: "b",
 }
 
 
-class Move:
+# zobrist keys, from a fixed seed so hashes are stable between runs
+_zobrist_random = random.Random(0x5EED)
+ZOBRIST_PIECES = [[_zobrist_random.getrandbits(64) for _ in range(64)] for _ in range(12)]  # by Piece.value
+ZOBRIST_CASTLING = [_zobrist_random.getrandbits(64) for _ in range(16)]  # by castling rights
+ZOBRIST_EN_PASSANT = [_zobrist_random.getrandbits(64) for _ in range(8)]  # by file
+ZOBRIST_BLACK_TURN = _zobrist_random.getrandbits(64)
+
+
+def square_name(pos: Vec2):
+    return "abcdefgh"[pos.j] + str(pos.i + 1)
+
+
+class Move(int):
 
-    def __init__(self, t: MoveType, p1: Vec2, p2: Vec2):
-        self.type = t
-        self.src = p1
-        self.dst = p2
+    # a move packed into an int: src | dst << 6 | MoveType.value << 12, squares being i * 8 + j.
+    # move generation works on plain ints, Move only adds the accessors
+    __slots__ = ()
+
+    def __new__(cls, t: MoveType, p1: Vec2, p2: Vec2):
+        return int.__new__(cls, square(p1) | square(p2) << 6 | t.value << 12)
+
+    @classmethod
+    def from_code(cls, code):
+        return int.__new__(cls, code)
+
+    @property
+    def type(self):
+        return MOVE_TYPES[self >> 12]
+
+    @property
+    def src(self):
+        return ALL_POS[self & 63]
+
+    @property
+    def dst(self):
+        return ALL_POS[self >> 6 & 63]
 
     def __str__(self):
         return f"({self.type}, {self.src}, {self.dst})"
 
+    def __repr__(self):
+        return f"Move({self.type}, {self.src}, {self.dst})"
+
+    def uci(self):
+        return square_name(self.src) + square_name(self.dst) + UCI_PROMOTIONS.get(self.type, "")
+
+
+class TranspositionTable:
+
+    # maps a position key to an entry, dropping the least recently used entry when full
+    def __init__(self, capacity=1 << 16):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+
 
 class ChessBoard:
 
-    def __init__(self, start_board):
+    def __init__(self, start_board, turn=Player.White, table: TranspositionTable = None):
+        self.turn = turn
         self.board = start_board
-
-        self.board_history = []
+        # generated moves and check status per (hash, player), see TranspositionTable
+        self.table = table
+
+        self.history = []
+
+    @classmethod
+    def from_fen(cls, fen):
+        chess_board = cls(EMPTY_BOARD)
+        chess_board.set_fen(fen)
+        return chess_board
+
+    def set_fen(self, fen):
+        # loads the position in place, so one board can be reused for many positions. the undo history
+        # starts over, castling rights missing from fen are inferred from the home squares and rights
+        # whose king or rook isn't on its home square are dropped.
+        # the whole FEN is checked before anything changes, a bad one raises ValueError and leaves the board as it was
+        fields = fen.split()
+        rows = fields[0].split("/") if fields else []
+        if len(rows) != 8:
+            raise ValueError(f"bad FEN placement: {fen}")
+        placement = []
+        for i, row in enumerate(reversed(rows)):
+            file = 0
+            for c in row:
+                if c in "12345678":
+                    file += int(c)
+                elif c in FEN_PIECES and file < 8:
+                    if c in "pP" and i in (0, 7):
+                        raise ValueError(f"bad FEN rank, a pawn on the first or last rank: {row}")
+                    placement.append((i * 8 + file, FEN_PIECES[c]))
+                    file += 1
+                else:
+                    raise ValueError(f"bad FEN rank: {row}")
+            if file != 8:
+                raise ValueError(f"bad FEN rank: {row}")
+        if len(fields) > 1 and fields[1] not in ("w", "b"):
+            raise ValueError(f"bad FEN side to move: {fields[1]}")
+        en_passant = None
+        if len(fields) > 3 and fields[3] != "-":
+            if len(fields[3]) != 2 or fields[3][0] not in "abcdefgh" or fields[3][1] not in "36":
+                raise ValueError(f"bad FEN en passant square: {fields[3]}")
+            en_passant = (int(fields[3][1]) - 1) * 8 + "abcdefgh".index(fields[3][0])
+        clocks = (0, 1)
+        if len(fields) > 5:
+            if not (fields[4].isdigit() and fields[5].isdigit()):
+                raise ValueError(f"bad FEN move counters: {fields[4]} {fields[5]}")
+            clocks = (int(fields[4]), int(fields[5]))
+
+        self.squares = [Piece.Empty] * 64
+        self.bitboards = [0] * 12
+        self.occupancy = [0, 0]
+        for sq, piece in placement:
+            self._put(sq, piece)
+        self.turn = Player.Black if len(fields) > 1 and fields[1] == "b" else Player.White
+        if len(fields) > 2:
+            self.castling = sum(FEN_CASTLES[c] for c in set(fields[2]) if c in FEN_CASTLES)
+            self.castling &= self._home_castling()
+        else:
+            self.castling = self._home_castling()
+        self.en_passant = en_passant
+        self.halfmove_clock, self.fullmove_number = clocks
+        self.history = []
+        self.rehash()
+
+    def fen(self):
+        rows = []
+        for i in range(7, -1, -1):
+            row, empty = "", 0
+            for p in self.squares[i * 8:i * 8 + 8]:
+                if p == Piece.Empty:
+                    empty += 1
+                    continue
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                row += PIECE_FEN[p]
+            rows.append(row + (str(empty) if empty else ""))
+
+        castling = "".join(c for c, right in FEN_CASTLES.items() if self.castling & right) or "-"
+        en_passant = square_name(ALL_POS[self.en_passant]) if self.en_passant is not None else "-"
+        return (f"{'/'.join(rows)} {'w' if self.turn.is_white() else 'b'} {castling} {en_passant} "
+                f"{self.halfmove_clock} {self.fullmove_number}")
+
+    def move_from_uci(self, text):
+        # the legal move of the side to move written as text in coordinate notation, e.g. e7e8q
+        for move in self.all_possible_move(self.turn):
+            if move.uci() == text:
+                return move
+        raise ValueError(f"illegal move: {text}")
+
+    @property
+    def board(self):
+        return [self.squares[i * 8:i * 8 + 8] for i in range(8)]
+
+    @board.setter
+    def board(self, board):
+        self.squares = [Piece.Empty] * 64
+        self.bitboards = [0] * 12  # by Piece.value
+        self.occupancy = [0, 0]  # by Player.value
+        self.hash = 0
+        for pos in ALL_POS:
+            if board[pos.i][pos.j] != Piece.Empty:
+                self._put(square(pos), board[pos.i][pos.j])
+
+        self.castling = self._home_castling()
+        self.en_passant = None
+        self.halfmove_clock = 0  # plies since the last capture or pawn move
+        self.fullmove_number = 1
+        self.rehash()
+
+    def _home_castling(self):
+        # a castle is allowed as long as its king and rook stand on their starting squares
+        castling = 0
+        for (player, _), rule in CASTLES.items():
+            king, rook = PLAYER_PIECES[player][5], PLAYER_PIECES[player][3]
+            if self.squares[rule.king_src] == king and self.squares[rule.rook_src] == rook:
+                castling |= rule.right
+        return castling
+
+    def compute_hash(self):
+        h = ZOBRIST_CASTLING[self.castling]
+        for sq in bits(self.occupancy[0] | self.occupancy[1]):
+            h ^= ZOBRIST_PIECES[PIECE_INDEX[self.squares[sq]]][sq]
+        if self.en_passant is not None:
+            h ^= ZOBRIST_EN_PASSANT[self.en_passant & 7]
+        if self.turn == Player.Black:
+            h ^= ZOBRIST_BLACK_TURN
+        return h
+
+    def rehash(self):
+        # call after changing castling, en_passant or turn directly, restarts repetition counting
+        self.hash = self.compute_hash()
+        self.position_counts = {self.hash: 1}
+
+    def repetitions(self):
+        # how many times the current position occurred in the game
+        return self.position_counts.get(self.hash, 0)
+
+    def is_threefold_repetition(self):
+        return self.repetitions() >= 3
 
     def __setitem__(self, pos: Vec2, value):
-        self.board[pos.i][pos.j] = value
+        sq = square(pos)
+        if self.squares[sq] != Piece.Empty:
+            self._remove(sq)
+        if value != Piece.Empty:
+            self._put(sq, value)
 
     def __getitem__(self, pos: Vec2):
-        return self.board[pos.i][pos.j]
-    
+        return self.squares[pos.i * 8 + pos.j]
+
+    def _put(self, sq, piece: Piece):
+        b = 1 << sq
+        self.squares[sq] = piece
+        self.bitboards[PIECE_INDEX[piece]] |= b
+        self.occupancy[PIECE_SIDE[piece]] |= b
+        self.hash ^= ZOBRIST_PIECES[PIECE_INDEX[piece]][sq]
+
+    def _remove(self, sq):
+        piece = self.squares[sq]
+        b = ~(1 << sq)
+        self.squares[sq] = Piece.Empty
+        self.bitboards[PIECE_INDEX[piece]] &= b
+        self.occupancy[PIECE_SIDE[piece]] &= b
+        self.hash ^= ZOBRIST_PIECES[PIECE_INDEX[piece]][sq]
+        return piece
+
+    def attackers(self, sq, player: Player, occ=None):
+        # bitboard of player's pieces attacking square sq, occ overrides the board occupancy
+        pawn, knight, bishop, rook, queen, king = (self.bitboards[PIECE_INDEX[p]] for p in PLAYER_PIECES[player])
+        if occ is None:
+            occ = self.occupancy[0] | self.occupancy[1]
+        return (PAWN_ATTACKS[1 - player.value][sq] & pawn
+                | KNIGHT_ATTACKS[sq] & knight
+                | KING_ATTACKS[sq] & king
+                | bishop_attacks(sq, occ) & (bishop | queen)
+                | rook_attacks(sq, occ) & (rook | queen))
+
+    def is_square_attacked(self, pos: Vec2, player: Player):
+        return bool(self.attackers(square(pos), player))
+
+    def attacked_squares(self, player: Player, occ=None):
+        # every square attacked by player
+        pawn, knight, bishop, rook, queen, king = (self.bitboards[PIECE_INDEX[p]] for p in PLAYER_PIECES[player])
+        if occ is None:
+            occ = self.occupancy[0] | self.occupancy[1]
+        attacked = 0
+        for sq in bits(pawn):
+            attacked |= PAWN_ATTACKS[player.value][sq]
+        for sq in bits(knight):
+            attacked |= KNIGHT_ATTACKS[sq]
+        for sq in bits(bishop | queen):
+            attacked |= bishop_attacks(sq, occ)
+        for sq in bits(rook | queen):
+            attacked |= rook_attacks(sq, occ)
+        for sq in bits(king):
+            attacked |= KING_ATTACKS[sq]
+        return attacked
+
+    def attack_counts(self, player: Player):
+        # how many of player's pieces attack each square, by square
+        pawn, knight, bishop, rook, queen, king = (self.bitboards[PIECE_INDEX[p]] for p in PLAYER_PIECES[player])
+        occ = self.occupancy[0] | self.occupancy[1]
+        counts = [0] * 64
+        attacks = [PAWN_ATTACKS[player.value][sq] for sq in bits(pawn)]
+        attacks.extend(KNIGHT_ATTACKS[sq] for sq in bits(knight))
+        attacks.extend(bishop_attacks(sq, occ) for sq in bits(bishop | queen))
+        attacks.extend(rook_attacks(sq, occ) for sq in bits(rook | queen))
+        attacks.extend(KING_ATTACKS[sq] for sq in bits(king))
+        for bb in attacks:
+            for sq in bits(bb):
+                counts[sq] += 1
+        return counts
+
+    def pinned(self, player: Player):
+        # player's pieces pinned to their king, mapped to the line they can still move along
+        king = self.bitboards[PIECE_INDEX[PLAYER_PIECES[player][5]]]
+        if not king:
+            return {}
+        king_sq = king.bit_length() - 1
+        _, _, bishop, rook, queen, _ = (self.bitboards[PIECE_INDEX[p]] for p in PLAYER_PIECES[player.oponent()])
+        own = self.occupancy[player.value]
+        occ = own | self.occupancy[1 - player.value]
+
+        pins = {}
+        snipers = ROOK_LINES[king_sq] & (rook | queen) | BISHOP_LINES[king_sq] & (bishop | queen)
+        for s in bits(snipers):
+            between = BETWEEN[king_sq][s]
+            blockers = between & occ
+            if blockers & own and not blockers & (blockers - 1):
+                pins[blockers.bit_length() - 1] = between | (1 << s)
+        return pins
+
     def is_castle_possible(self, player: Player, left_side):
-        if player == Player.White:
-            rook_pos = Vec2(0, 0) if left_side else Vec2(0, 7)
-            rook_type = Piece.WR
-            king_pos = Vec2(0, 4)
-            king_type = Piece.WK
-            empty_pos = [Vec2(0, 3), Vec2(0, 2), Vec2(0, 1)] if left_side else [Vec2(0, 5), Vec2(0, 6)]
+        rule = CASTLES[player, MoveType.CastleLeft if left_side else MoveType.CastleRight]
+        if not self.castling & rule.right or (self.occupancy[0] | self.occupancy[1]) & rule.empty:
+            return False
+        opponent = player.oponent()
+        return not any(self.attackers(sq, opponent) for sq in rule.safe)
+
+    def play_move(self, move):
+        # move is a Move or its packed int: src | dst << 6 | type << 12
+        src, dst, t = move & 63, move >> 6 & 63, move >> 12
+        piece = self.squares[src]
+        player = piece.player()
+        captured, captured_sq = Piece.Empty, dst
+        old_hash = self.hash
+
+        if t in CASTLE_MOVE_TYPES:
+            rule = CASTLES[player, MOVE_TYPES[t]]
+            self._put(rule.king_dst, self._remove(rule.king_src))
+            self._put(rule.rook_dst, self._remove(rule.rook_src))
         else:
-            rook_pos = Vec2(7, 7) if left_side else Vec2(7, 0)
-            rook_type = Piece.BR
-            king_pos = Vec2(7, 4)
-            king_type = Piece.BK
-            empty_pos = [Vec2(7, 5), Vec2(7, 6)] if left_side else [Vec2(7, 3), Vec2(7, 2), Vec2(7, 1)]
-
-        for b in self.board_history:
-            if b[rook_pos.i][rook_pos.j] != rook_type or b[king_pos.i][king_pos.j] != king_type:
-                return False
-            
-        return all([self[p].is_empty() for p in empty_pos])
-
-    def play_move(self, move: Move):
-        # move is a 3 tuple: (type, src, dst)
-        self.board_history.append(deepcopy(self.board))
-
-        if move.type == MoveType.Normal:
-            self[move.dst] = self[move.src]
-            self[move.src] = Piece.Empty
-        elif move.type == MoveType.CastleLeft or move.type == MoveType.CastleRight:
-            if move.type == MoveType.CastleLeft and move.src == Vec2(0, 4):
-                template = CASTLE_WHITE_LEFT.items()
-            elif move.type == MoveType.CastleLeft:
-                template = CASTLE_BLACK_LEFT.items()
-            elif move.type == MoveType.CastleRight and move.src == Vec2(0, 4):
-                template = CASTLE_WHITE_RIGHT.items()
+            if t == EN_PASSANT_MOVE:
+                captured_sq = dst - 8 if player.is_white() else dst + 8
+            if self.squares[captured_sq] != Piece.Empty:
+                captured = self._remove(captured_sq)
+
+            self._remove(src)
+            if t in PROMOTION_MOVE_TYPES:
+                self._put(dst, PROMOTION_PIECES[MOVE_TYPES[t], player])
             else:
-                template = CASTLE_BLACK_RIGHT.items()
-            
-            for pos, p in template:
-                self[pos] = p
-        elif move.type == MoveType.PromotionQueen:
-            self[move.dst] = Piece.WQ if move.dst.i == 7 else Piece.BQ
-            self[move.src] = Piece.Empty
+                self._put(dst, piece)
 
+        # only what is needed to take the move back, the position itself is never copied
+        self.history.append((t, src, dst, piece, captured, captured_sq,
+                             self.castling, self.en_passant, self.turn, old_hash, self.halfmove_clock))
+
+        if captured != Piece.Empty or piece in (Piece.WP, Piece.BP):
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        if player == Player.Black:
+            self.fullmove_number += 1
+
+        h = self.hash ^ ZOBRIST_CASTLING[self.castling]
+        if self.en_passant is not None:
+            h ^= ZOBRIST_EN_PASSANT[self.en_passant & 7]
+        if self.turn != player.oponent():
+            h ^= ZOBRIST_BLACK_TURN
+        self.turn = player.oponent()
+
+        if piece in (Piece.WP, Piece.BP) and abs(dst - src) == 16:
+            self.en_passant = (src + dst) // 2
+            h ^= ZOBRIST_EN_PASSANT[self.en_passant & 7]
+        else:
+            self.en_passant = None
+        self.castling &= CASTLING_MASKS[src] & CASTLING_MASKS[dst]
+        self.hash = h ^ ZOBRIST_CASTLING[self.castling]
+        self.position_counts[self.hash] = self.position_counts.get(self.hash, 0) + 1
 
     def reverse_move(self):
-        self.board = self.board_history.pop()
+        count = self.position_counts.pop(self.hash) - 1
+        if count:
+            self.position_counts[self.hash] = count
+
+        (t, src, dst, piece, captured, captured_sq,
+         self.castling, self.en_passant, self.turn, h, self.halfmove_clock) = self.history.pop()
+        if piece.player() == Player.Black:
+            self.fullmove_number -= 1
+
+        if t in CASTLE_MOVE_TYPES:
+            rule = CASTLES[piece.player(), MOVE_TYPES[t]]
+            self._put(rule.king_src, self._remove(rule.king_dst))
+            self._put(rule.rook_src, self._remove(rule.rook_dst))
+        else:
+            self._remove(dst)
+            self._put(src, piece)
+            if captured != Piece.Empty:
+                self._put(captured_sq, captured)
+        self.hash = h
+
+    def _table_entry(self, player: Player):
+        # [move codes, checked] cached for this position, None values are filled in on demand
+        key = (self.hash, player.value)
+        entry = self.table.get(key)
+        if entry is None:
+            entry = self.table.put(key, [None, None])
+        return entry
 
     def is_checked(self, player: Player):
-        moves = self.all_possible_move(player.oponent(), check_test=True)
-        king_pos = None
-
-        for pos in ALL_POS:
-            if self[pos] == (Piece.WK if player == Player.White else Piece.BK):
-                king_pos = pos
-
-        for move in moves:
-            if king_pos == move.dst and move.type == MoveType.Normal:
-                if self[move.src] in [Piece.WP, Piece.BP]:
-                    if move.src.j != move.dst.j:
-                        return True
-                else:
-                    return True
-                
-        return False
+        if self.table is not None:
+            entry = self._table_entry(player)
+            if entry[1] is None:
+                entry[1] = self._is_checked(player)
+            return entry[1]
+        return self._is_checked(player)
+
+    def _is_checked(self, player: Player):
+        king = self.bitboards[PIECE_INDEX[PLAYER_PIECES[player][5]]]
+        return bool(king) and bool(self.attackers(king.bit_length() - 1, player.oponent()))
+
+    def move_codes(self, player: Player):
+        # legal moves as packed ints, served from the transposition table when there is one
+        if self.table is not None:
+            entry = self._table_entry(player)
+            if entry[0] is None:
+                entry[0] = self.legal_moves(player)
+            return entry[0]
+        return self.legal_moves(player)
 
     def all_possible_move(self, player: Player, check_test=False):
-        moves = []
-        for pos in ALL_POS:
-            moves.extend(self.possible_moves(pos, player, check_test))
-        return moves
+        if check_test:
+            codes = []
+            for sq in bits(self.occupancy[player.value]):
+                codes.extend(self.pseudo_legal_moves(sq, self.squares[sq], player, castles=False))
+        else:
+            codes = self.move_codes(player)
+        return [Move.from_code(c) for c in codes]
 
     def possible_moves(self, pos: Vec2, player: Player, check_test=False):
-        p = self[pos]
-        moves = []
+        # with check_test the pseudo legal moves are returned, without castles
+        sq = square(pos)
+        p = self.squares[sq]
 
-        if p == Piece.Empty:
+        if p == Piece.Empty or p.player() != player:
             return []
-        elif p == Piece.WK and player == Player.White:
-            moves = self.k_possible_moves(pos, player, check_test=True)
-        elif p == Piece.BK and player == Player.Black:
-            moves = self.k_possible_moves(pos, player)
-        elif p == Piece.WQ and player == Player.White:
-            moves = self.q_possible_moves(pos, player)
-        elif p == Piece.BQ and player == Player.Black:
-            moves = self.q_possible_moves(pos, player)
-        elif p == Piece.WR and player == Player.White:
-            moves = self.r_possible_moves(pos, player)
-        elif p == Piece.BR and player == Player.Black:
-            moves = self.r_possible_moves(pos, player)
-        elif p == Piece.WB and player == Player.White:
-            moves = self.b_possible_moves(pos, player)
-        elif p == Piece.BB and player == Player.Black:
-            moves = self.b_possible_moves(pos, player)
-        elif p == Piece.WN and player == Player.White:
-            moves = self.n_possible_moves(pos, player)
-        elif p == Piece.BN and player == Player.Black:
-            moves = self.n_possible_moves(pos, player)
-        elif p == Piece.WP and player == Player.White:
-            moves = self.p_possible_moves(pos, player)
-        elif p == Piece.BP and player == Player.Black:
-            moves = self.p_possible_moves(pos, player)
-
-        legal_moves = []
-        for m in moves:
-            self.play_move(m)
-            if (check_test or not self.is_checked(player)) and not (check_test and m.type != MoveType.Normal):
-                legal_moves.append(m)
-            self.reverse_move()
-        
-        for m in legal_moves:
-            if m.src is None:
-                print(pos, m)
-                exit(-1)
-
-        return legal_moves
-
-    def k_possible_moves(self, pos: Vec2, player: Player, check_test=False):
+        if check_test:
+            codes = self.pseudo_legal_moves(sq, p, player, castles=False)
+        elif self.table is not None:
+            codes = [c for c in self.move_codes(player) if c & 63 == sq]
+        else:
+            codes = self.legal_moves(player, 1 << sq)
+        return [Move.from_code(c) for c in codes]
+
+    def legal_moves(self, player: Player, from_mask=FULL_BOARD, to_mask=FULL_BOARD):
+        # legal moves of player's pieces standing on from_mask to squares in to_mask, as packed ints. checkers,
+        # pins and the squares the king can't step on are found once, so no move has to be played to test it
+        pawn, knight, bishop, rook, queen, king = PLAYER_PIECES[player]
+        opponent = player.oponent()
+        own = self.occupancy[player.value]
+        occ = own | self.occupancy[opponent.value]
+        king_bb = self.bitboards[PIECE_INDEX[king]]
         moves = []
 
-        for d in VERTICAL_DIRECTIONS + DIAGONAL_DIRECTIONS:
-            p = pos + d
-            if p.is_legal() and self[p].player() != player:
-                m = Move(MoveType.Normal, pos, p)
-                moves.append(m)
-
-        if not check_test and not self.is_checked(player):
-            # check left castle
-            if self.is_castle_possible(player, True):
-                moves.append(Move(MoveType.CastleLeft, 
-                                Vec2(0, 4) if player.is_white() else Vec2(7, 4),
-                                Vec2(0, 2) if player.is_white() else Vec2(7, 6)))
-            # check left castle
-            if self.is_castle_possible(player, False):
-                moves.append(Move(MoveType.CastleRight,
-                                Vec2(0, 4) if player.is_white() else Vec2(7, 4),
-                                Vec2(0, 6) if player.is_white() else Vec2(7, 2)))
+        if not king_bb:
+            for sq in bits(own & from_mask):
+                moves.extend(m for m in self.pseudo_legal_moves(sq, self.squares[sq], player, castles=False)
+                             if to_mask >> (m >> 6 & 63) & 1)
+            return moves
+
+        king_sq = king_bb.bit_length() - 1
+        checkers = self.attackers(king_sq, opponent)
+
+        if king_bb & from_mask:
+            targets = KING_ATTACKS[king_sq] & ~own & to_mask
+            if targets:
+                # the king doesn't block the attacks it is stepping away from
+                danger = self.attacked_squares(opponent, occ ^ king_bb)
+                moves.extend(king_sq | t << 6 for t in bits(targets & ~danger))
+            if not checkers:
+                for castle in (MoveType.CastleLeft, MoveType.CastleRight):
+                    rule = CASTLES[player, castle]
+                    if (rule.king_src == king_sq and to_mask >> rule.king_dst & 1
+                            and self.is_castle_possible(player, castle == MoveType.CastleLeft)):
+                        moves.append(king_sq | rule.king_dst << 6 | castle.value << 12)
+
+        if checkers & (checkers - 1):
+            # double check, only the king can move
+            return moves
+
+        if checkers:
+            check_mask = checkers | BETWEEN[king_sq][checkers.bit_length() - 1]
+        else:
+            check_mask = FULL_BOARD
+        pins = self.pinned(player)
+
+        for sq in bits(own & from_mask & ~king_bb):
+            p = self.squares[sq]
+            allowed = check_mask & pins.get(sq, FULL_BOARD) & to_mask
+            if p == pawn:
+                for m in self.p_possible_moves(sq, player):
+                    if m >> 12 == EN_PASSANT_MOVE:
+                        if not to_mask >> (m >> 6 & 63) & 1:
+                            continue
+                        # the captured pawn leaves the rank too, which can uncover the king
+                        self.play_move(m)
+                        if not self.is_checked(player):
+                            moves.append(m)
+                        self.reverse_move()
+                    elif allowed >> (m >> 6 & 63) & 1:
+                        moves.append(m)
+                continue
+
+            if p == knight:
+                targets = KNIGHT_ATTACKS[sq]
+            elif p == bishop:
+                targets = bishop_attacks(sq, occ)
+            elif p == rook:
+                targets = rook_attacks(sq, occ)
+            else:
+                targets = bishop_attacks(sq, occ) | rook_attacks(sq, occ)
+            moves.extend(sq | t << 6 for t in bits(targets & ~own & allowed))
 
         return moves
 
-    def q_possible_moves(self, pos: Vec2, player: Player):
-        moves = []
-
-        for d in VERTICAL_DIRECTIONS + DIAGONAL_DIRECTIONS:
-            p = pos + d
-            while p.is_legal() and self[p] == Piece.Empty:
-                if p.is_legal():
-                    m = Move(MoveType.Normal, pos, p)
-                    moves.append(m)
-                p = p + d
-            if p.is_legal() and self[p].player() != player:
-                m = Move(MoveType.Normal, pos, p)
-                moves.append(m)
+    def pseudo_legal_moves(self, sq, p: Piece, player: Player, castles=True):
+        pawn, knight, bishop, rook, queen, king = PLAYER_PIECES[player]
+        own = self.occupancy[player.value]
+        occ = own | self.occupancy[player.oponent().value]
+
+        if p == pawn:
+            return self.p_possible_moves(sq, player)
+        elif p == knight:
+            targets = KNIGHT_ATTACKS[sq]
+        elif p == bishop:
+            targets = bishop_attacks(sq, occ)
+        elif p == rook:
+            targets = rook_attacks(sq, occ)
+        elif p == queen:
+            targets = bishop_attacks(sq, occ) | rook_attacks(sq, occ)
+        else:
+            targets = KING_ATTACKS[sq]
 
-        return moves
+        moves = [sq | t << 6 for t in bits(targets & ~own)]
 
-    def r_possible_moves(self, pos: Vec2, player: Player):
-        moves = []
-
-        for d in VERTICAL_DIRECTIONS:
-            p = pos + d
-            while p.is_legal() and self[p] == Piece.Empty:
-                if p.is_legal():
-                    m = Move(MoveType.Normal, pos, p)
-                    moves.append(m)
-                p = p + d
-            if p.is_legal() and self[p].player() != player:
-                m = Move(MoveType.Normal, pos, p)
-                moves.append(m)
+        if p == king and castles:
+            for castle in (MoveType.CastleLeft, MoveType.CastleRight):
+                rule = CASTLES[player, castle]
+                if rule.king_src == sq and self.is_castle_possible(player, castle == MoveType.CastleLeft):
+                    moves.append(sq | rule.king_dst << 6 | castle.value << 12)
 
         return moves
 
-    def b_possible_moves(self, pos: Vec2, player: Player):
+    def p_possible_moves(self, sq, player: Player):
         moves = []
+        occ = self.occupancy[0] | self.occupancy[1]
+        step, start_rank, last_rank = (8, 1, 7) if player.is_white() else (-8, 6, 0)
+
+        targets = []
+        if not occ & (1 << (sq + step)):
+            targets.append(sq + step)
+            if sq >> 3 == start_rank and not occ & (1 << (sq + 2 * step)):
+                moves.append(sq | (sq + 2 * step) << 6)
+        targets.extend(bits(PAWN_ATTACKS[player.value][sq] & self.occupancy[player.oponent().value]))
+
+        for t in targets:
+            if t >> 3 == last_rank:
+                moves.extend(sq | t << 6 | promotion for promotion in PROMOTION_CODES)
+            else:
+                moves.append(sq | t << 6)
 
-        for d in DIAGONAL_DIRECTIONS:
-            p = pos + d
-            while p.is_legal() and self[p] == Piece.Empty:
-                if p.is_legal():
-                    m = Move(MoveType.Normal, pos, p)
-                    moves.append(m)
-                p = p + d
-            if p.is_legal() and self[p].player() != player:
-                m = Move(MoveType.Normal, pos, p)
-                moves.append(m)
-
-        return moves
-
-    def n_possible_moves(self, pos, player: Player):
-        moves = []
+        if self.en_passant is not None and PAWN_ATTACKS[player.value][sq] & (1 << self.en_passant):
+            moves.append(sq | self.en_passant << 6 | EN_PASSANT_MOVE << 12)
 
-        for d in KNIGHT_DIRECTIONS:
-            p = pos + d
-            if p.is_legal() and self[p].player() != player:
-                m = Move(MoveType.Normal, pos, p)
-                moves.append(m)
         return moves
 
-    def p_possible_moves(self, pos, player: Player):
-        moves = []
 
-        d = Vec2(1, 0) if player == Player.White else Vec2(-1, 0)
-        if self[pos + d] == Piece.Empty:
-            if (pos + d).i not in [0, 7]:
-                moves.append(Move(MoveType.Normal, pos, pos + d))
-            else:
-                moves.append(Move(MoveType.PromotionQueen, pos, pos + d))
-            if (pos.i == (1 if player == Player.White else 6)) and self[(pos + d) + d] == Piece.Empty:
-                moves.append(Move(MoveType.Normal, pos, pos + d + d))
-
-        new_p = pos + (Vec2(1, 1) if player == Player.White else Vec2(-1, 1))
-        if new_p.is_legal():
-            piece = self[new_p]
-            if piece.player() != None and piece.player() != player:
-                if new_p.i not in [0, 7]:
-                    moves.append(Move(MoveType.Normal, pos, new_p))
-                else:
-                    moves.append(Move(MoveType.PromotionQueen, pos, new_p))
-
-        new_p = pos + (Vec2(1, -1) if player == Player.White else Vec2(-1, -1))
-        if new_p.is_legal():
-            piece = self[new_p]
-            if piece.player() != None and piece.player() != player:
-                if new_p.i not in [0, 7]:
-                    moves.append(Move(MoveType.Normal, pos, new_p))
-                else:
-                    moves.append(Move(MoveType.PromotionQueen, pos, new_p))
+def takes_time_limit(player_fn):
+    # whether a player callable accepts the time_limit keyword
+    try:
+        parameters = inspect.signature(player_fn).parameters.values()
+    except (TypeError, ValueError):
+        return False
+    return any(p.name == "time_limit" or p.kind == p.VAR_KEYWORD for p in parameters)
+
+
+class PendingMove:
+
+    # a bot move computed on a worker thread, so the window keeps running while the bot thinks
+    def __init__(self, player_fn, board, player: Player, think_time=None):
+        self.player_fn = player_fn
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.started = time.monotonic()
+        self.done = threading.Event()
+
+        # players that take a time_limit keyword get the think-time budget, in seconds
+        kwargs = {"time_limit": think_time} if think_time is not None and takes_time_limit(player_fn) else {}
+        self.thread = threading.Thread(target=self._run, args=(board, player, kwargs), daemon=True)
+        self.thread.start()
+
+    def _run(self, board, player, kwargs):
+        try:
+            self.result = self.player_fn(board, player, **kwargs)
+        except Exception as e:
+            self.error = e
+        self.done.set()
+
+    def is_done(self):
+        return self.done.is_set()
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def cancel(self):
+        # the thread can't be killed, its move is dropped and a player with a stop() is asked to hurry
+        self.cancelled = True
+        stop = getattr(self.player_fn, "stop", None)
+        if stop is not None:
+            stop()
+
+
+class MoveHints:
+
+    # the legal moves of one position by source square, built on a worker thread as soon as the position
+    # is reached, so a click is a lookup. the worker gets its own board, the window keeps playing on its one
+    def __init__(self, chess_board: ChessBoard):
+        self.key = chess_board.hash  # the position the hints belong to, the hash includes the side to move
+        self.by_square = {}
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(chess_board.fen(),), daemon=True)
+        self.thread.start()
+
+    def _run(self, fen):
+        try:
+            chess_board = ChessBoard.from_fen(fen)
+            by_square = {}
+            for code in chess_board.legal_moves(chess_board.turn):
+                by_square.setdefault(code & 63, []).append(Move.from_code(code))
+            self.by_square = by_square
+        finally:
+            self.done.set()
+
+    def moves(self, pos: Vec2):
+        # waits for the worker if the click came before it finished
+        self.done.wait()
+        return self.by_square.get(square(pos), [])
 
-        return moves
 
 class ChessViz:
 
-    def __init__(self, start_board, player_white, player_black, turn=Player.White):
-        self.chess_board = ChessBoard(start_board)
+    def __init__(self, start_board, player_white, player_black, turn=Player.White, think_time=None, theme=PIECE_TYPE,
+                 pgn_path=None, instruments=None, archive_path=None):
+        self.chess_board = ChessBoard(start_board, turn, TranspositionTable())
+        self.start_fen = self.chess_board.fen()
+        self.moves = []
+        self.pgn_path = pgn_path  # the game is appended to this file when the window is closed
+        self.archive_path = archive_path  # and to this archive.py game archive
         self.turn = turn
         self.player_white = player_white
         self.player_black = player_black
+        self.think_time = think_time
+        self.pending_move = None
+        self.over = None  # why the game ended, bots aren't asked for moves once it is set
+        self.theme = theme
 
         self.screen = None
+        self.drawn = [None] * 64  # (piece, clicked, marked) currently drawn on each square
 
         self.click_1 = None
         self.click_2 = None
 
         self.possible_moves = []
+        self.hints = None  # MoveHints of the position on the board when a human is to move
+
+        # see instrument.py, the overlay is toggled with the I key
+        self.instruments = instruments
+        self.show_overlay = instruments is not None
+        self.overlay = None
+        self.overlay_rect = None
+        self.overlay_refresh = 0
+        self.font = None
 
     def start_game(self):
         pygame.init()
         pygame.display.set_caption('ChessMonster Visualizer')
 
         self.screen = pygame.display.set_mode(SCREEN_SIZE)
+        self.drawn = [None] * 64
         self.draw_board()
         pygame.display.update()
 
         self.future_move = None
+        self.update_hints()
+        clock = pygame.time.Clock()
 
         while True:
-            # add potential delay here
+            frame_start = time.perf_counter()
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
+                    self.cancel_pending_move()
+                    if self.pgn_path is not None:
+                        self.save_pgn(self.pgn_path)
+                    if self.archive_path is not None:
+                        self.save_archive(self.archive_path)
                     exit(0)
+                elif event.type == pygame.VIDEOEXPOSE:
+                    self.drawn = [None] * 64
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_t:
+                    self.set_theme(THEMES[(THEMES.index(self.theme) + 1) % len(THEMES)])
+                elif event.type == pygame.KEYDOWN and event.key == pygame.K_i and self.instruments is not None:
+                    self.toggle_overlay()
                 elif event.type == pygame.MOUSEBUTTONDOWN:
                     pos = pygame.mouse.get_pos()
                     pos = (7 - pos[1] // SQUARE_SIZE, pos[0] // SQUARE_SIZE)
                     if self.click_1 == None:
                         self.click_1 = pos
-                        self.possible_moves = self.chess_board.possible_moves(Vec2(*pos), self.turn)
+                        self.possible_moves = self.hint_moves(Vec2(*pos))
                     elif self.click_2 == None:
                         if self.click_1 == pos:
                             self.click_1 = None
                             self.possible_moves = []
                         else:
+                            # promotions come queen first, so the first move to the square is played
                             possible_dst = [((m.dst.i, m.dst.j), m) for m in self.possible_moves]
                             for dst, m in possible_dst:
                                 if pos == dst:
                                     self.click_2 = pos
                                     self.future_move = m
+                                    break
                             else:
                                 self.click_1 = None
                                 self.possible_moves = []
@@ -505,7 +1145,8 @@ class ChessViz:
             if self.turn == Player.White:
                 played = True
                 if self.player_white != None:  # bot
-                    move = self.player_white(self.chess_board.board, self.turn)
+                    move = self.poll_bot(self.player_white)
+                    played = move is not None
                 elif self.click_2 != None:  # user input
                     # move = Move(MoveType.Normal, Vec2(*self.click_1), Vec2(*self.click_2))
                     move = self.future_move
@@ -518,12 +1159,15 @@ class ChessViz:
                     self.chess_board.play_move(move)
                     self.turn = Player.Black
                     self.possible_moves = []
+                    self.update_hints()
+                    self.moves.append(move)
 
                     print(f"white: {move.src} -> {move.dst}")
             else:
                 played = True
                 if self.player_black != None:  # bot
-                    move = self.player_black(self.chess_board.board, self.turn)
+                    move = self.poll_bot(self.player_black)
+                    played = move is not None
                 elif self.click_2 != None:  # user input
                     # move = Move(MoveType.Normal, Vec2(*self.click_1), Vec2(*self.click_2))
                     move = self.future_move
@@ -536,49 +1180,167 @@ class ChessViz:
                     self.chess_board.play_move(move)
                     self.turn = Player.White
                     self.possible_moves = []
+                    self.update_hints()
+                    self.moves.append(move)
 
                     print(f"black: {move.src} -> {move.dst}")
 
-            self.draw_board()
-            pygame.display.update()
-            
+            # only the squares that changed are redrawn and pushed to the display
+            dirty = self.draw_board()
+            if self.show_overlay:
+                dirty += self.draw_overlay(dirty, clock.get_fps())
+            if dirty:
+                pygame.display.update(dirty)
+            if self.instruments is not None:
+                self.instruments.record("frame", time.perf_counter() - frame_start)
+            clock.tick(FPS)
+
+    def update_hints(self):
+        # called whenever a move is played, the hints are only built for a human player
+        human = self.player_white is None if self.turn == Player.White else self.player_black is None
+        self.hints = MoveHints(self.chess_board) if human else None
+
+    def hint_moves(self, pos: Vec2):
+        # the legal moves from pos. hints built for another position (a move was played or taken back
+        # since) are dropped and the moves are generated here
+        if self.hints is None or self.hints.key != self.chess_board.hash:
+            self.hints = None
+            return self.chess_board.possible_moves(pos, self.turn)
+        return self.hints.moves(pos)
+
+    def save_pgn(self, path, headers=None):
+        from pgn import game_from_moves, game_result, write_game
+
+        headers = {"Result": game_result(self.chess_board), **(headers or {})}
+        game = game_from_moves(self.moves, ChessBoard.from_fen(self.start_fen), headers)
+        with open(path, "a") as f:
+            write_game(f, game)
+
+    def save_archive(self, path, headers=None):
+        from archive import GameArchive
+        from pgn import game_result
+
+        start_fen = None if self.start_fen == ChessBoard(START_BOARD).fen() else self.start_fen
+        with GameArchive(path, "a") as archive:
+            archive.append(self.moves, game_result(self.chess_board), headers, start_fen)
+
+    def poll_bot(self, player_fn):
+        # starts the bot on a worker thread, returns its move once it is ready and None until then.
+        # the bot gets a copy of the board with castling rights, en passant and history, and its move
+        # is matched against the legal moves, which also fills in castle / promotion types
+        if self.over is not None:
+            return None
+        if self.pending_move is None:
+            if not self.chess_board.move_codes(self.turn):
+                self.end_game("checkmate" if self.chess_board.is_checked(self.turn) else "stalemate")
+                return None
+            board = ChessBoard.from_fen(self.chess_board.fen())
+            self.pending_move = PendingMove(player_fn, board, self.turn, self.think_time)
+        if not self.pending_move.is_done():
+            return None
+        pending, self.pending_move = self.pending_move, None
+        if self.instruments is not None:
+            self.instruments.record("bot_round_trip", pending.elapsed())
+        try:
+            return self.chess_board.move_from_uci(pending.get().uci())
+        except Exception as e:  # an illegal move, or the bot failed
+            self.end_game(f"{self.turn} bot: {e!r}")
+            return None
+
+    def end_game(self, reason):
+        self.over = reason
+        print(f"game over: {reason}")
+        pygame.display.set_caption(f"ChessMonster Visualizer - {reason}")
+
+    def cancel_pending_move(self):
+        if self.pending_move is not None:
+            self.pending_move.cancel()
+            self.pending_move = None
+
+    def set_theme(self, theme):
+        self.theme = theme
+        self.drawn = [None] * 64
+
+    def toggle_overlay(self):
+        self.show_overlay = not self.show_overlay
+        self.overlay_refresh = 0
+        if not self.show_overlay and self.overlay_rect is not None:
+            # the next draw_board paints the squares under it again
+            for sq in self.squares_under(self.overlay_rect):
+                self.drawn[sq] = None
+            self.overlay_rect = None
+
+    def squares_under(self, rect):
+        return [i * 8 + j for i, j in product(range(8), repeat=2)
+                if rect.colliderect(pygame.Rect(j * SQUARE_SIZE, (7 - i) * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE))]
+
+    def draw_overlay(self, dirty, fps):
+        # the instruments in the top left corner, rendered again a few times a second. it is drawn on
+        # freshly drawn squares every time, so its translucent background never blends over itself
+        now = time.monotonic()
+        refresh = now >= self.overlay_refresh
+        if not refresh and self.overlay_rect.collidelist(dirty) < 0:
+            return []
+
+        area = self.overlay_rect
+        if refresh:
+            self.overlay_refresh = now + OVERLAY_INTERVAL
+            if self.font is None:
+                self.font = pygame.font.Font(None, OVERLAY_FONT_SIZE)
+            lines = [self.font.render(line, True, OVERLAY_TEXT_COLOR)
+                     for line in [f"{fps:.0f} fps"] + self.instruments.summary()]
+            height = self.font.get_linesize()
+            self.overlay = pygame.Surface((max(line.get_width() for line in lines) + 8, height * len(lines) + 8),
+                                          pygame.SRCALPHA)
+            self.overlay.fill(OVERLAY_COLOR)
+            for k, line in enumerate(lines):
+                self.overlay.blit(line, (4, 4 + k * height))
+            self.overlay_rect = self.overlay.get_rect()
+            area = self.overlay_rect if area is None else area.union(self.overlay_rect)
+
+        rects = [self.draw_square(sq // 8, sq % 8, *self.drawn[sq]) for sq in self.squares_under(area)]
+        self.screen.blit(self.overlay, self.overlay_rect)
+        return rects + [self.overlay_rect]
+
     def draw_board(self):
-        # draw board squares
-        self.screen.fill(BLACK_SQUARE_COLOR)
-        for i in range(8):
-            for j in range(8):
-                square = (j * SQUARE_SIZE, (7 - i) * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE)
-                if (i + j) % 2 == 0:
-                    if (i, j) == self.click_1:
-                        color = CLICK_1_WHITE_COLOR
-                    else:
-                        color = WHITE_SQUARE_COLOR
-                else:
-                    if (i, j) == self.click_1:
-                        color = CLICK_1_BLACK_COLOR
-                    else:
-                        color = BLACK_SQUARE_COLOR
-                pygame.draw.rect(self.screen, color, square)
-
-        # draw possible moves
-        move_dst = [(m.dst.i, m.dst.j) for m in self.possible_moves]
-        for pos in move_dst:
-            center = (pos[1] * SQUARE_SIZE + SQUARE_SIZE // 2, (7 - pos[0]) * SQUARE_SIZE + SQUARE_SIZE // 2)
-            color = WHITE_POSSIBLE_MOVE_COLOR if (pos[0] + pos[1]) % 2 == 0 else BLACK_POSSIBLE_MOVE_COLOR
-            radius = POSSIBLE_MOVE_CIRCLE_RADIUS_EMPTY if self.chess_board[Vec2(*pos)] == Piece.Empty else POSSIBLE_MOVE_CIRCLE_RADIUS_NON_EMPTY
-            pygame.draw.circle(self.screen, color , center, radius)
-
-        # draw pieces
-        for i in range(8):
-            for j in range(8):
-                piece = self.chess_board[Vec2(7 - i, j)]
-                if piece != Piece.Empty:
-                    self.screen.blit(PIECE_IMG[piece], (j * SQUARE_SIZE, i * SQUARE_SIZE))
-
-
-def bot(board, player: Player):
+        # draws the squares whose piece, click or move marker changed since the last call and
+        # returns their rects. self.drawn holds what is on screen, reset it to redraw everything
+        move_dst = {(m.dst.i, m.dst.j) for m in self.possible_moves}
+        dirty = []
+        for pos in ALL_POS:
+            i, j = pos.i, pos.j
+            state = (self.chess_board[pos], (i, j) == self.click_1, (i, j) in move_dst)
+            if state != self.drawn[i * 8 + j]:
+                self.drawn[i * 8 + j] = state
+                dirty.append(self.draw_square(i, j, *state))
+        return dirty
+
+    def draw_square(self, i, j, piece, clicked, marked):
+        square = pygame.Rect(j * SQUARE_SIZE, (7 - i) * SQUARE_SIZE, SQUARE_SIZE, SQUARE_SIZE)
+        if (i + j) % 2 == 0:
+            color = CLICK_1_WHITE_COLOR if clicked else WHITE_SQUARE_COLOR
+        else:
+            color = CLICK_1_BLACK_COLOR if clicked else BLACK_SQUARE_COLOR
+        pygame.draw.rect(self.screen, color, square)
+
+        # draw possible move
+        if marked:
+            color = WHITE_POSSIBLE_MOVE_COLOR if (i + j) % 2 == 0 else BLACK_POSSIBLE_MOVE_COLOR
+            radius = POSSIBLE_MOVE_CIRCLE_RADIUS_EMPTY if piece == Piece.Empty else POSSIBLE_MOVE_CIRCLE_RADIUS_NON_EMPTY
+            pygame.draw.circle(self.screen, color, square.center, radius)
+
+        # draw piece
+        if piece != Piece.Empty:
+            self.screen.blit(PIECE_SPRITES.sprites(self.theme)[piece], square.topleft)
+        return square
+
+
+def bot(board, player: Player, time_limit=None):
+    # the external engine has no time control, time_limit is accepted and ignored
+    if isinstance(board, ChessBoard):
+        board = board.board
     new_board = transform_board(board, player)
-    board_str = ' '.join([' '.join([str(p).zfill(2) for p in r]) for r in new_board])
+    board_str = ' '.join([BOT_CELLS[p] for r in new_board for p in r])
     r = str(subprocess.call(BOT_EXE + ' ' + board_str, stdin=None, stdout=None, stderr=None, shell=True))[1:]
     print(f"        bit output: {r}")
     if player.is_white():
@@ -589,7 +1351,13 @@ def bot(board, player: Player):
 
 
 def main():
-    viz = ChessViz(START_BOARD, None, None)
+    # CHESS_VIZ_STATS=<path> turns the instruments on and writes them to path as JSON on exit
+    instruments = None
+    if os.environ.get("CHESS_VIZ_STATS"):
+        import instrument
+
+        instruments = instrument.enable(os.environ["CHESS_VIZ_STATS"], (ChessBoard, ChessViz))
+    viz = ChessViz(START_BOARD, None, None, instruments=instruments)
     viz.start_game()
     # print(bot(viz.chess_board.board))
 
@@ -0,0 +1,90 @@
+import itertools
+
+import numpy as np
+
+from chess_viz import BOT_CELLS, ChessBoard, INT_PIECE_FORMAT, Piece, Player
+
+
+# array encodings of positions for bots and evaluation models.
+# squares are indexed [rank][file] like ChessBoard.board, rank 0 is white's back rank.
+# an 8x8 int8 array holds the INT_PIECE_FORMAT code of every square, a 12x8x8 uint8 stack
+# holds one plane per piece, plane k is set where the piece with code k + 1 stands
+
+# pieces in the order of their codes, and the ChessBoard.bitboards index of each plane
+PLANE_PIECES = sorted((p for p in Piece if p != Piece.Empty), key=INT_PIECE_FORMAT.get)
+PLANE_BITBOARDS = np.array([p.value for p in PLANE_PIECES])
+PLANE_CODES = np.arange(1, 13, dtype=np.uint8)
+
+# the same piece of the other colour, by code and by plane
+FLIP_CODES = np.array([0] + list(range(7, 13)) + list(range(1, 7)), dtype=np.int8)
+FLIP_PLANES = np.r_[6:12, 0:6]
+
+
+def bitboards(board):
+    # the 12 bitboards (by Piece.value) of a ChessBoard or an 8x8 board list
+    if isinstance(board, ChessBoard):
+        return board.bitboards
+    res = [0] * 12
+    for sq, p in enumerate(itertools.chain.from_iterable(board)):
+        if p != Piece.Empty:
+            res[p.value] |= 1 << sq
+    return res
+
+
+def flip_codes(arrays):
+    # the position seen from the other side: ranks reversed and colours swapped, for (..., 8, 8) code arrays
+    return FLIP_CODES[arrays[..., ::-1, :]]
+
+
+def flip_planes(planes):
+    # flip_codes for (..., 12, 8, 8) plane stacks
+    return planes[..., FLIP_PLANES, ::-1, :]
+
+
+def _flip_mask(boards, player, n):
+    # which boards are flipped: all of them for Player.Black, none for Player.White,
+    # with player None every ChessBoard is seen from its side to move (8x8 lists from white's)
+    if player is None:
+        return np.fromiter((isinstance(b, ChessBoard) and not b.turn.is_white() for b in boards), dtype=bool, count=n)
+    return np.full(n, not player.is_white())
+
+
+def planes_batch(boards, player: Player = Player.White, out=None):
+    # the (n, 12, 8, 8) uint8 plane stacks of a sequence of boards, in one contiguous buffer.
+    # the planes are unpacked from the bitboards, no square is visited in Python for a ChessBoard
+    n = len(boards)
+    bbs = np.fromiter(itertools.chain.from_iterable(bitboards(b) for b in boards), dtype="<u8", count=n * 12)
+    bbs = np.ascontiguousarray(bbs.reshape(n, 12)[:, PLANE_BITBOARDS])
+    planes = np.unpackbits(bbs.view(np.uint8), axis=-1, bitorder="little").reshape(n, 12, 8, 8)
+
+    flip = _flip_mask(boards, player, n)
+    if flip.any():
+        planes[flip] = flip_planes(planes[flip])
+    if out is None:
+        return planes
+    out[...] = planes
+    return out
+
+
+def encode_batch(boards, player: Player = Player.White, out=None):
+    # the (n, 8, 8) int8 code arrays of a sequence of boards, in one contiguous buffer
+    planes = planes_batch(boards, player)
+    codes = np.matmul(PLANE_CODES, planes.reshape(len(boards), 12, 64)).astype(np.int8).reshape(-1, 8, 8)
+    if out is None:
+        return codes
+    out[...] = codes
+    return out
+
+
+def board_array(board, player: Player = Player.White):
+    # the 8x8 int8 array of one board, the same codes as transform_board
+    return encode_batch([board], player)[0]
+
+
+def board_planes(board, player: Player = Player.White):
+    return planes_batch([board], player)[0]
+
+
+def bot_argument(array):
+    # the board argument of the bot executable for an 8x8 code array
+    return " ".join([BOT_CELLS[c] for c in array.ravel().tolist()])
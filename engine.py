@@ -0,0 +1,166 @@
+import queue
+import shlex
+import subprocess
+import threading
+import time
+
+from chess_viz import ChessBoard, Move, Player
+
+
+class EngineError(RuntimeError):
+    pass
+
+
+class UciEngine:
+
+    # keeps one engine process open and asks it for moves over the UCI protocol on stdin/stdout.
+    # can be used directly as player_white / player_black of ChessViz. command starts a UCI engine
+    # (e.g. "stockfish"), the bundled BOT_EXE speaks its own board protocol and can't be used here
+    def __init__(self, command, movetime=1000, timeout=5.0, options=None):
+        self.command = command
+        self.movetime = movetime  # milliseconds per move
+        self.timeout = timeout  # seconds to wait for a reply on top of the move time
+        self.options = options or {}
+
+        self.process = None
+        self.lines = None
+        self.restarts = 0
+        self.last_info = {}  # depth / score / nodes of the last search, as reported by the engine
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getstate__(self):
+        # a copy sent to another process starts its own engine on first use
+        state = self.__dict__.copy()
+        state["process"] = None
+        state["lines"] = None
+        return state
+
+    def __call__(self, board, player: Player, time_limit=None):
+        # ChessViz and batch.py hand over a copy of their ChessBoard, an 8x8 list (older callers) is
+        # loaded with castling rights inferred from the home squares and no en passant square
+        if not isinstance(board, ChessBoard):
+            board = ChessBoard(board, player)
+        return self.best_move(board, None if time_limit is None else int(time_limit * 1000))
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.process = subprocess.Popen(shlex.split(self.command), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, text=True, bufsize=1)
+        self.lines = queue.Queue()
+        threading.Thread(target=self._read_lines, args=(self.process, self.lines), daemon=True).start()
+
+        self._send("uci")
+        self._wait_for("uciok", self.timeout)
+        for name, value in self.options.items():
+            self._send(f"setoption name {name} value {value}")
+        self._send("isready")
+        self._wait_for("readyok", self.timeout)
+
+    def restart(self):
+        self.kill()
+        self.restarts += 1
+        self.start()
+
+    def close(self):
+        if self.is_running():
+            try:
+                self._send("quit")
+                self.process.wait(self.timeout)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        self.kill()
+
+    def kill(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+    def stop(self):
+        # cut the current search short, the waiting best_move gets the engine's answer
+        if self.is_running():
+            self._send("stop")
+
+    def new_game(self):
+        if not self.is_running():
+            self.start()
+        self._send("ucinewgame")
+        self._send("isready")
+        self._wait_for("readyok", self.timeout)
+
+    def best_move(self, chess_board: ChessBoard, movetime=None) -> Move:
+        movetime = self.movetime if movetime is None else movetime
+
+        # a crashed engine is restarted and asked once more
+        for attempt in range(2):
+            if not self.is_running():
+                if self.process is not None:  # died since the last move
+                    self.restarts += 1
+                self.start()
+            try:
+                self._send("position fen " + chess_board.fen())
+                self._send(f"go movetime {movetime}")
+                reply = self._bestmove(movetime / 1000 + self.timeout)
+                return chess_board.move_from_uci(reply.split()[1])
+            except (BrokenPipeError, EOFError):
+                if attempt:
+                    raise EngineError(f"engine {self.command!r} keeps crashing")
+                self.kill()
+                self.restarts += 1
+
+    def _bestmove(self, timeout):
+        try:
+            return self._wait_for("bestmove", timeout)
+        except TimeoutError:
+            pass
+        # out of time, the engine should answer "stop" with the best move it has so far
+        self._send("stop")
+        try:
+            return self._wait_for("bestmove", self.timeout)
+        except TimeoutError:
+            self.restart()
+            raise TimeoutError(f"engine {self.command!r} didn't answer in time")
+
+    def _send(self, line):
+        self.process.stdin.write(line + "\n")
+        self.process.stdin.flush()
+
+    def _wait_for(self, command, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                line = self.lines.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                raise TimeoutError(f"no {command} from engine {self.command!r}")
+            if line is None:
+                raise EOFError(f"engine {self.command!r} exited")
+
+            tokens = line.split()
+            if tokens and tokens[0] == "info":
+                self._parse_info(tokens)
+            elif tokens and tokens[0] == command:
+                return line
+
+    def _parse_info(self, tokens):
+        for key in ("depth", "nodes", "nps", "time"):
+            if key in tokens[:-1]:
+                self.last_info[key] = int(tokens[tokens.index(key) + 1])
+        if "score" in tokens[:-2]:
+            i = tokens.index("score")
+            self.last_info["score"] = (tokens[i + 1], int(tokens[i + 2]))  # ("cp", centipawns) or ("mate", moves)
+
+    @staticmethod
+    def _read_lines(process, lines):
+        # a reader thread, so waiting for a reply can time out
+        for line in process.stdout:
+            lines.put(line.strip())
+        lines.put(None)
@@ -0,0 +1,165 @@
+import argparse
+import io
+import random
+import struct
+import sys
+import time
+
+import numpy as np
+
+from chess_viz import ChessBoard, START_BOARD
+from render import BoardRenderer, GIF_DELAY, lzw_encode, quantize, write_gif
+
+
+# round trip check of render.py's GIF writer: buffers and frames are encoded, decoded again by the plain
+# LZW decoder of the GIF89a spec below and compared with what went in
+
+MAX_CODE_SIZE = 12
+
+
+def lzw_decode(data, npixels, min_code_size=8):
+    # the palette indices of a GIF image's LZW data, read code by code as the spec describes
+    clear, end = 1 << min_code_size, (1 << min_code_size) + 1
+    stream = int.from_bytes(data, "little")
+    position, code_size = 0, min_code_size + 1
+    table, previous = None, None
+    out = bytearray()
+    while True:
+        if position + code_size > len(data) * 8:
+            raise ValueError("LZW data ends without an end code")
+        code = stream >> position & (1 << code_size) - 1
+        position += code_size
+        if code == clear:
+            table = [bytes([c]) for c in range(clear)] + [b"", b""]
+            code_size, previous = min_code_size + 1, None
+            continue
+        if code == end:
+            break
+        if table is None:
+            raise ValueError("LZW data doesn't start with a clear code")
+        if previous is None:
+            entry = table[code]
+        else:
+            if code < len(table):
+                entry = table[code]
+            elif code == len(table):
+                entry = table[previous] + table[previous][:1]
+            else:
+                raise ValueError(f"LZW code {code} isn't in the table yet")
+            if len(table) < 1 << MAX_CODE_SIZE:
+                table.append(table[previous] + entry[:1])
+                if len(table) == 1 << code_size and code_size < MAX_CODE_SIZE:
+                    code_size += 1
+        out += entry
+        previous = code
+    if len(out) != npixels:
+        raise ValueError(f"LZW data holds {len(out)} pixels, the image has {npixels}")
+    return bytes(out)
+
+
+def decode_gif(data):
+    # the frames of a GIF as palette index arrays, each one drawn over the previous (disposal 1)
+    width, height, flags = struct.unpack_from("<HHB", data, 6)
+    p = 13 + (3 << (flags & 7) + 1 if flags & 0x80 else 0)
+    canvas = np.zeros((height, width), np.uint8)
+    frames, transparent = [], None
+    while data[p] != 0x3B:
+        if data[p] == 0x21:
+            if data[p + 1] == 0xF9:
+                transparent = data[p + 6] if data[p + 3] & 1 else None
+            p += 2
+            while data[p]:
+                p += data[p] + 1
+            p += 1
+        elif data[p] == 0x2C:
+            left, top, w, h, _ = struct.unpack_from("<HHHHB", data, p + 1)
+            min_code_size = data[p + 10]
+            p += 11
+            blocks = bytearray()
+            while data[p]:
+                blocks += data[p + 1:p + 1 + data[p]]
+                p += data[p] + 1
+            p += 1
+            image = np.frombuffer(lzw_decode(blocks, w * h, min_code_size), np.uint8).reshape(h, w)
+            region = canvas[top:top + h, left:left + w]
+            if transparent is None:
+                region[:] = image
+            else:
+                region[image != transparent] = image[image != transparent]
+            frames.append(canvas.copy())
+        else:
+            raise ValueError(f"unknown GIF block {data[p]:#x} at {p}")
+    return frames
+
+
+def random_buffer(rng: random.Random):
+    # noise, a few colours, or long runs of a few colours like a board, sometimes past 4096 codes
+    n = rng.choice((rng.randint(1, 64), rng.randint(1, 5000), rng.randint(5000, 60000)))
+    kind = rng.randrange(3)
+    if kind == 0:
+        return bytes(rng.getrandbits(8) for _ in range(n))
+    colors = [rng.getrandbits(8) for _ in range(rng.randint(1, 6))]
+    if kind == 1:
+        return bytes(rng.choice(colors) for _ in range(n))
+    out = bytearray()
+    while len(out) < n:
+        out += bytes([rng.choice(colors)]) * rng.choice((1, rng.randint(1, 80), rng.randint(80, 3000)))
+    return bytes(out[:n])
+
+
+def check_buffers(count, rng: random.Random):
+    failures = 0
+    for k in range(count):
+        data = random_buffer(rng)
+        try:
+            error = None if lzw_decode(lzw_encode(data), len(data)) == data else "decoded bytes differ"
+        except ValueError as e:
+            error = e
+        if error is not None:
+            print(f"buffer {k} ({len(data)} bytes) FAILED: {error}")
+            failures += 1
+    print(f"{count} LZW buffers  {'ok' if not failures else f'{failures} FAILED'}")
+    return failures
+
+
+def check_game(plies, size, rng: random.Random):
+    # the frames of a random game against the frames decoded from its GIF
+    renderer = BoardRenderer(size)
+    chess_board = ChessBoard(START_BOARD)
+    frames = [quantize(renderer.rgb(chess_board))]
+    for _ in range(plies):
+        codes = chess_board.legal_moves(chess_board.turn)
+        if not codes:
+            break
+        move = rng.choice(codes)
+        chess_board.play_move(move)
+        frames.append(quantize(renderer.rgb(chess_board, (move & 63, move >> 6 & 63))))
+    f = io.BytesIO()
+    write_gif(f, frames, [GIF_DELAY] * len(frames))
+    try:
+        decoded = decode_gif(f.getvalue())
+        ok = len(decoded) == len(frames) and all((a == b).all() for a, b in zip(decoded, frames))
+    except ValueError as e:
+        print(f"game: {e}")
+        ok = False
+    print(f"game GIF  {len(frames)} frames  {len(f.getvalue())} bytes  {'ok' if ok else 'FAILED'}")
+    return 0 if ok else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="round trip check of the GIF encoder against a spec LZW decoder")
+    parser.add_argument("-n", "--buffers", type=int, default=300)
+    parser.add_argument("--plies", type=int, default=60, help="length of the random game animated")
+    parser.add_argument("-s", "--size", type=int, default=240)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    failures = check_buffers(args.buffers, rng) + check_game(args.plies, args.size, rng)
+    print(f"{'all ok' if not failures else f'{failures} FAILED'} in {time.perf_counter() - start:.1f}s")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
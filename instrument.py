@@ -0,0 +1,133 @@
+import atexit
+import functools
+import json
+import time
+
+from chess_viz import ChessBoard, ChessViz
+
+
+class Histogram:
+
+    # latencies in power of two microsecond buckets: bucket k counts the calls of 2 ** (k - 1) to 2 ** k us
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * 40
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[min(int(seconds * 1e6).bit_length(), len(self.buckets) - 1)] += 1
+
+    def percentile(self, q):
+        # upper bound of the bucket holding the q-th percentile, in seconds
+        rank = q / 100 * self.count
+        seen = 0
+        for k, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return (1 << k) / 1e6
+        return 0.0
+
+    def to_dict(self):
+        return {"count": self.count, "total_s": self.total, "mean_s": self.total / max(self.count, 1),
+                "max_s": self.max, "p50_s": self.percentile(50), "p99_s": self.percentile(99),
+                "buckets_us": {1 << k: n for k, n in enumerate(self.buckets) if n}}
+
+
+class Instruments:
+
+    # counters and latency histograms by name
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(seconds)
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
+        self.started = time.time()
+
+    def snapshot(self):
+        return {"started": self.started, "elapsed_s": time.time() - self.started, "counters": dict(self.counters),
+                "histograms": {name: h.to_dict() for name, h in self.histograms.items()}}
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def summary(self):
+        # one line per histogram and counter, for the ChessViz overlay
+        lines = []
+        for name, h in sorted(self.histograms.items()):
+            lines.append(f"{name}: {h.count}x p50 {h.percentile(50) * 1000:.2f} p99 {h.percentile(99) * 1000:.2f} "
+                         f"max {h.max * 1000:.1f} ms")
+        for name, n in sorted(self.counters.items()):
+            lines.append(f"{name}: {n}")
+        return lines
+
+
+INSTRUMENTS = Instruments()
+
+
+def _timed(name, method, count=None):
+    # method recording its latency under name, count is (counter name, function of the result adding to it)
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = method(*args, **kwargs)
+        INSTRUMENTS.record(name, time.perf_counter() - start)
+        if count is not None:
+            INSTRUMENTS.count(count[0], count[1](result))
+        return result
+
+    wrapper.instrumented = method
+    return wrapper
+
+
+# (class name, method, counter name and how much a call adds to it)
+HOT_PATHS = [
+    ("ChessBoard", "legal_moves", ("moves_generated", len)),
+    ("ChessBoard", "possible_moves", None),
+    ("ChessBoard", "all_possible_move", None),
+    ("ChessBoard", "is_checked", ("legality_probes", lambda result: 1)),
+    ("ChessBoard", "play_move", ("history_entries", lambda result: 1)),
+    ("ChessBoard", "reverse_move", None),
+    ("ChessViz", "draw_board", ("squares_drawn", len)),
+]
+
+
+def _hot_paths(classes):
+    by_name = {cls.__name__: cls for cls in classes}
+    return [(by_name[cls], name, count) for cls, name, count in HOT_PATHS if cls in by_name]
+
+
+def enable(dump_path=None, classes=(ChessBoard, ChessViz)):
+    # opt-in: wraps the hot paths, so nothing is measured (or slowed down) until this is called.
+    # with dump_path the numbers are written there as JSON when the process exits.
+    # chess_viz run as a script passes its own classes, they aren't the ones of the imported module
+    for cls, name, count in _hot_paths(classes):
+        method = getattr(cls, name)
+        if not hasattr(method, "instrumented"):
+            setattr(cls, name, _timed(name, method, count))
+    if dump_path is not None:
+        atexit.register(INSTRUMENTS.dump, dump_path)
+    return INSTRUMENTS
+
+
+def disable(classes=(ChessBoard, ChessViz)):
+    for cls, name, _ in _hot_paths(classes):
+        method = getattr(cls, name)
+        if hasattr(method, "instrumented"):
+            setattr(cls, name, method.instrumented)
@@ -0,0 +1,94 @@
+import argparse
+import sys
+import time
+
+from chess_viz import ChessBoard, Move, START_BOARD
+
+
+# (name, fen, leaf counts by depth) from the chessprogramming wiki perft results
+POSITIONS = [
+    ("start", None, [20, 400, 8902, 197281, 4865609]),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", [48, 2039, 97862, 4085603]),
+    ("position3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", [14, 191, 2812, 43238, 674624]),
+    ("position4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1", [6, 264, 9467, 422333]),
+    ("position5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", [44, 1486, 62379, 2103487]),
+    ("position6", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10", [46, 2079, 89890, 3894594]),
+]
+
+
+def load_position(fen):
+    if fen is None:
+        return ChessBoard(START_BOARD)
+    return ChessBoard.from_fen(fen)
+
+
+def perft(chess_board: ChessBoard, depth):
+    # number of leaf nodes depth plies below the position, with chess_board.turn to move
+    moves = chess_board.legal_moves(chess_board.turn)
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+
+    nodes = 0
+    for move in moves:
+        chess_board.play_move(move)
+        nodes += perft(chess_board, depth - 1)
+        chess_board.reverse_move()
+    return nodes
+
+
+def divide(chess_board: ChessBoard, depth):
+    # perft split by root move, keyed by the move in coordinate notation
+    result = {}
+    for move in chess_board.legal_moves(chess_board.turn):
+        chess_board.play_move(move)
+        result[Move.from_code(move).uci()] = perft(chess_board, depth - 1)
+        chess_board.reverse_move()
+    return result
+
+
+def run_suite(max_depth, out=sys.stdout):
+    # runs every reference position up to max_depth, returns the number of mismatches
+    mismatches = 0
+    total_nodes, total_time = 0, 0.0
+    for name, fen, expected in POSITIONS:
+        for depth in range(1, min(max_depth, len(expected)) + 1):
+            start = time.perf_counter()
+            nodes = perft(load_position(fen), depth)
+            elapsed = time.perf_counter() - start
+            total_nodes += nodes
+            total_time += elapsed
+
+            ok = nodes == expected[depth - 1]
+            mismatches += not ok
+            status = "ok" if ok else f"MISMATCH (expected {expected[depth - 1]})"
+            print(f"{name:<10} depth {depth}: {nodes:>9} nodes {elapsed:8.3f}s {nodes / max(elapsed, 1e-9):>10.0f} nps  {status}", file=out)
+
+    print(f"total: {total_nodes} nodes in {total_time:.3f}s, {total_nodes / max(total_time, 1e-9):.0f} nps", file=out)
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="perft move generation benchmark and correctness check")
+    parser.add_argument("-d", "--depth", type=int, default=3)
+    parser.add_argument("--fen", help="run a single position instead of the reference suite")
+    parser.add_argument("--divide", action="store_true", help="print the node count of every root move")
+    args = parser.parse_args()
+
+    if args.fen is None and not args.divide:
+        sys.exit(1 if run_suite(args.depth) else 0)
+
+    chess_board = load_position(args.fen)
+    start = time.perf_counter()
+    if args.divide:
+        counts = divide(chess_board, args.depth)
+        for move, nodes in sorted(counts.items()):
+            print(f"{move}: {nodes}")
+        nodes = sum(counts.values())
+    else:
+        nodes = perft(chess_board, args.depth)
+    elapsed = time.perf_counter() - start
+    print(f"nodes: {nodes} in {elapsed:.3f}s, {nodes / max(elapsed, 1e-9):.0f} nps")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import re
+
+from chess_viz import ChessBoard, Move, MoveType, PIECE_FEN, PLAYER_PIECES, Piece, START_BOARD, square_name
+
+
+RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+SAN_PATTERN = re.compile(r"^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?$")
+SAN_PROMOTIONS = {"Q": MoveType.PromotionQueen, "N": MoveType.PromotionKnight,
+                  "R": MoveType.PromotionRook, "B": MoveType.PromotionBishop}
+PROMOTION_LETTERS = {t: letter for letter, t in SAN_PROMOTIONS.items()}
+SAN_PROMOTION_VALUES = tuple(t.value for t in SAN_PROMOTIONS.values())
+# pieces of a player by SAN letter, the pawn has none
+SAN_PIECES = {letter: index for index, letter in enumerate(["", "N", "B", "R", "Q", "K"])}
+TOKEN_PATTERN = re.compile(r"\{[^}]*\}?|;.*|\$\d+|\(|\)|[^\s{}();]+")
+MOVE_NUMBER = re.compile(r"^\d+\.+")
+
+
+class PgnGame:
+
+    def __init__(self, headers=None, moves=None):
+        self.headers = headers if headers is not None else {}
+        self.moves = moves if moves is not None else []  # SAN strings of the main line
+
+    @property
+    def result(self):
+        return self.headers.get("Result", "*")
+
+    def start_board(self):
+        if "FEN" in self.headers:
+            return ChessBoard.from_fen(self.headers["FEN"])
+        return ChessBoard(START_BOARD)
+
+    def play(self, chess_board=None):
+        # plays the game on chess_board (a fresh start board by default), yielding each move after it is played
+        if chess_board is None:
+            chess_board = self.start_board()
+        for san in self.moves:
+            move = parse_san(chess_board, san)
+            chess_board.play_move(move)
+            yield move
+
+
+def parse_san(chess_board: ChessBoard, san):
+    # the legal move of the side to move written in standard algebraic notation
+    text = san.rstrip("+#!?")
+    player = chess_board.turn
+    codes = chess_board.move_codes(player)
+
+    if text in ("O-O", "0-0", "O-O-O", "0-0-0"):
+        king_file = 6 if len(text) == 3 else 2
+        for code in codes:
+            if code >> 12 in (MoveType.CastleLeft.value, MoveType.CastleRight.value) and (code >> 6) & 7 == king_file:
+                return Move.from_code(code)
+        raise ValueError(f"illegal move: {san}")
+
+    match = SAN_PATTERN.match(text)
+    if match is None:
+        raise ValueError(f"bad move: {san}")
+    letter, from_file, from_rank, dst, promotion = match.groups()
+    piece = PLAYER_PIECES[player][SAN_PIECES[letter or ""]]
+    dst_sq = (int(dst[1]) - 1) * 8 + "abcdefgh".index(dst[0])
+    promotion = SAN_PROMOTIONS[promotion].value if promotion else None
+
+    found = None
+    for code in codes:
+        src = code & 63
+        if (code >> 6) & 63 != dst_sq or chess_board.squares[src] != piece:
+            continue
+        if from_file is not None and "abcdefgh"[src & 7] != from_file:
+            continue
+        if from_rank is not None and str((src >> 3) + 1) != from_rank:
+            continue
+        t = code >> 12
+        if promotion is not None and t != promotion or promotion is None and t in SAN_PROMOTION_VALUES:
+            continue
+        if found is not None:
+            raise ValueError(f"ambiguous move: {san}")
+        found = code
+    if found is None:
+        raise ValueError(f"illegal move: {san}")
+    return Move.from_code(found)
+
+
+def move_san(chess_board: ChessBoard, move):
+    # standard algebraic notation of a legal move, before it is played
+    move = Move.from_code(move)
+    t, src, dst = move.type, move & 63, (move >> 6) & 63
+    if t in (MoveType.CastleLeft, MoveType.CastleRight):
+        san = "O-O" if dst & 7 == 6 else "O-O-O"
+    else:
+        piece = chess_board.squares[src]
+        capture = chess_board.squares[dst] != Piece.Empty or t == MoveType.EnPassant
+        if piece in (Piece.WP, Piece.BP):
+            san = (square_name(move.src)[0] + "x" if capture else "") + square_name(move.dst)
+            if t in PROMOTION_LETTERS:
+                san += "=" + PROMOTION_LETTERS[t]
+        else:
+            # the same kind of piece reaching the same square needs the source file and/or rank
+            rivals = [c & 63 for c in chess_board.move_codes(chess_board.turn)
+                      if (c >> 6) & 63 == dst and c & 63 != src and chess_board.squares[c & 63] == piece]
+            disambiguation = ""
+            if rivals:
+                name = square_name(move.src)
+                if all(r & 7 != src & 7 for r in rivals):
+                    disambiguation = name[0]
+                elif all(r >> 3 != src >> 3 for r in rivals):
+                    disambiguation = name[1]
+                else:
+                    disambiguation = name
+            san = PIECE_FEN[piece].upper() + disambiguation + ("x" if capture else "") + square_name(move.dst)
+
+    chess_board.play_move(move)
+    if chess_board.is_checked(chess_board.turn):
+        san += "#" if not chess_board.move_codes(chess_board.turn) else "+"
+    chess_board.reverse_move()
+    return san
+
+
+def read_games(file):
+    # yields the games of a PGN file one at a time, only the current game is held in memory.
+    # comments, NAGs and variations are skipped
+    headers, moves = {}, []
+    in_comment = False
+    depth = 0
+
+    for line in file:
+        if in_comment:
+            if "}" not in line:
+                continue
+            line = line[line.index("}") + 1:]
+            in_comment = False
+        stripped = line.strip()
+        if stripped.startswith("%"):
+            continue
+        if stripped.startswith("[") and depth == 0:
+            if moves:
+                yield PgnGame(headers, moves)
+                headers, moves = {}, []
+            tag = stripped[1:-1].split(" ", 1)
+            if len(tag) == 2:
+                headers[tag[0]] = tag[1].strip().strip('"').replace('\\"', '"')
+            continue
+
+        for token in TOKEN_PATTERN.findall(line):
+            if token.startswith("{"):
+                in_comment = not token.endswith("}")
+            elif token == "(":
+                depth += 1
+            elif token == ")":
+                depth = max(depth - 1, 0)
+            elif depth or token.startswith(";") or token.startswith("$"):
+                continue
+            elif token in RESULTS:
+                headers.setdefault("Result", token)
+                yield PgnGame(headers, moves)
+                headers, moves = {}, []
+            else:
+                token = MOVE_NUMBER.sub("", token)
+                if token:
+                    moves.append(token)
+
+    if moves or headers:
+        yield PgnGame(headers, moves)
+
+
+def write_game(file, game: PgnGame, width=80):
+    # writes one game in export format, a start position other than START_BOARD goes into the FEN tag
+    headers = {"Event": "?", "Site": "?", "Date": "????.??.??", "Round": "?", "White": "?", "Black": "?", "Result": "*"}
+    headers.update(game.headers)
+    for name, value in headers.items():
+        value = str(value).replace('"', '\\"')
+        file.write(f'[{name} "{value}"]\n')
+    file.write("\n")
+
+    # move numbers count from the start position, black to move starts with "n..."
+    chess_board = game.start_board()
+    number, white = chess_board.fullmove_number, chess_board.turn.is_white()
+    tokens = []
+    for i, san in enumerate(game.moves):
+        if white:
+            tokens.append(f"{number}.")
+        elif i == 0:
+            tokens.append(f"{number}...")
+        tokens.append(san)
+        if not white:
+            number += 1
+        white = not white
+    tokens.append(headers["Result"])
+
+    line = ""
+    for token in tokens:
+        if line and len(line) + 1 + len(token) > width:
+            file.write(line + "\n")
+            line = token
+        else:
+            line = f"{line} {token}" if line else token
+    file.write(line + "\n\n")
+
+
+def game_result(chess_board: ChessBoard):
+    # the result of a position the game ended in, "*" while it goes on
+    turn = chess_board.turn
+    if chess_board.legal_moves(turn):
+        return "1/2-1/2" if chess_board.is_threefold_repetition() else "*"
+    if chess_board.is_checked(turn):
+        return "0-1" if turn.is_white() else "1-0"
+    return "1/2-1/2"
+
+
+def game_from_moves(moves, chess_board: ChessBoard = None, headers=None):
+    # a PgnGame from Move objects or packed moves played from chess_board (START_BOARD by default)
+    if chess_board is None:
+        chess_board = ChessBoard(START_BOARD)
+    headers = dict(headers or {})
+    start_fen = chess_board.fen()
+    if start_fen != ChessBoard(START_BOARD).fen():
+        headers["SetUp"] = "1"
+        headers["FEN"] = start_fen
+
+    sans = []
+    for move in moves:
+        sans.append(move_san(chess_board, move))
+        chess_board.play_move(move)
+    for _ in sans:
+        chess_board.reverse_move()
+    return PgnGame(headers, sans)
+
+
+def write_games(file, games, width=80):
+    for game in games:
+        write_game(file, game, width)
@@ -0,0 +1,288 @@
+import argparse
+import multiprocessing
+import os
+import struct
+import sys
+
+# rendering never opens a window, without a display SDL would otherwise fail to start
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import numpy as np
+import pygame
+
+from chess_viz import (BLACK_SQUARE_COLOR, CLICK_1_BLACK_COLOR, CLICK_1_WHITE_COLOR, ChessBoard, PIECE_SPRITES,
+                       PIECE_TYPE, Piece, START_BOARD, WHITE_SQUARE_COLOR)
+
+
+# renders positions onto surfaces, no window or display is needed. sprites come from PIECE_SPRITES
+# and the empty board is drawn once per (size, highlight colours), so a frame is a handful of blits
+
+GIF_DELAY = 50  # centiseconds per ply
+GIF_LAST_DELAY = 300  # the final position is held longer before the animation loops
+# 6x6x6 colour cube, 32 greys for the anti-aliased sprite edges, then the board colours exactly
+BOARD_COLORS = [WHITE_SQUARE_COLOR, BLACK_SQUARE_COLOR, CLICK_1_WHITE_COLOR, CLICK_1_BLACK_COLOR]
+GIF_PALETTE = ([(r * 51, g * 51, b * 51) for r in range(6) for g in range(6) for b in range(6)]
+               + [(round(v * 255 / 31),) * 3 for v in range(32)]
+               + list(dict.fromkeys(BOARD_COLORS)))
+GIF_PALETTE += [(0, 0, 0)] * (256 - len(GIF_PALETTE))
+TRANSPARENT = 255  # a palette entry no colour is quantized to
+GREY_OFFSET, EXACT_OFFSET = 216, 248
+# channel value to its cube coordinate times the cube stride, and r + g + b of a grey to its ramp index
+_CUBE = np.rint(np.arange(256) / 51).astype(np.uint8)
+CUBE_36, CUBE_6, CUBE_1 = _CUBE * 36, _CUBE * 6, _CUBE
+GREY_INDEX = (GREY_OFFSET + np.rint(np.arange(766) / 3 * 31 / 255)).astype(np.uint8)
+
+
+class BoardRenderer:
+
+    def __init__(self, size=480, theme=PIECE_TYPE):
+        self.square = size // 8
+        self.size = self.square * 8
+        self.theme = theme
+        self.background = self._draw_background()
+
+    def _draw_background(self):
+        surface = pygame.Surface((self.size, self.size))
+        for i in range(8):
+            for j in range(8):
+                color = WHITE_SQUARE_COLOR if (i + j) % 2 == 0 else BLACK_SQUARE_COLOR
+                surface.fill(color, self.square_rect(i, j))
+        return surface
+
+    def square_rect(self, i, j):
+        return pygame.Rect(j * self.square, (7 - i) * self.square, self.square, self.square)
+
+    def render(self, board, highlight=(), surface=None):
+        # board is a ChessBoard or an 8x8 list, highlight holds squares (i * 8 + j) drawn in the click colour.
+        # surface is drawn over when given, so one surface can serve every frame
+        squares = board.squares if isinstance(board, ChessBoard) else [p for r in board for p in r]
+        if surface is None:
+            surface = pygame.Surface((self.size, self.size))
+        surface.blit(self.background, (0, 0))
+        for sq in highlight:
+            i, j = sq // 8, sq % 8
+            surface.fill(CLICK_1_WHITE_COLOR if (i + j) % 2 == 0 else CLICK_1_BLACK_COLOR, self.square_rect(i, j))
+        sprites = PIECE_SPRITES.sprites(self.theme, self.square)
+        for sq, piece in enumerate(squares):
+            if piece != Piece.Empty:
+                surface.blit(sprites[piece], self.square_rect(sq // 8, sq % 8))
+        return surface
+
+    def rgb(self, board, highlight=(), surface=None):
+        # the position as a (size, size, 3) uint8 array, rows from the top
+        surface = self.render(board, highlight, surface)
+        return np.frombuffer(pygame.image.tobytes(surface, "RGB"), dtype=np.uint8).reshape(self.size, self.size, 3)
+
+    def save_png(self, board, path, highlight=()):
+        pygame.image.save(self.render(board, highlight), path)
+
+    def save_gif(self, moves, path, start_board=None, delay=GIF_DELAY, last_delay=GIF_LAST_DELAY):
+        # an animation of the moves played from start_board (START_BOARD by default), one frame per ply
+        chess_board = ChessBoard(START_BOARD) if start_board is None else start_board
+        surface = pygame.Surface((self.size, self.size))
+        frames = [quantize(self.rgb(chess_board, (), surface))]
+        for move in moves:
+            chess_board.play_move(move)
+            frames.append(quantize(self.rgb(chess_board, (move & 63, move >> 6 & 63), surface)))
+        for _ in moves:
+            chess_board.reverse_move()
+        delays = [delay] * (len(frames) - 1) + [last_delay]
+        with open(path, "wb") as f:
+            write_gif(f, frames, delays)
+
+
+def quantize(rgb):
+    # palette indices of an rgb array: board colours exactly, near greys on the grey ramp, the rest on the cube.
+    # integer table lookups throughout, the channels are only ever 0..255
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    index = CUBE_36[r] + CUBE_6[g] + CUBE_1[b]
+    grey = np.maximum(np.maximum(r, g), b) - np.minimum(np.minimum(r, g), b) < 16
+    total = r.astype(np.uint16) + g + b
+    index[grey] = GREY_INDEX[total[grey]]
+    packed = r.astype(np.uint32) << 16 | g.astype(np.uint32) << 8 | b
+    for k, color in enumerate(GIF_PALETTE[EXACT_OFFSET:EXACT_OFFSET + len(BOARD_COLORS)]):
+        index[packed == (color[0] << 16 | color[1] << 8 | color[2])] = EXACT_OFFSET + k
+    return index
+
+
+def _run_ends(data):
+    # for every position, the end of the run of equal bytes it is in
+    values = np.frombuffer(data, np.uint8)
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(values)) + 1, [len(values)]))
+    return np.repeat(bounds[1:], np.diff(bounds)).tolist()
+
+
+def lzw_encode(data, min_code_size=8):
+    # GIF's variable length LZW of a bytes-like object of palette indices. boards are mostly long runs of
+    # one colour: while the current string is a run of one byte, the known strings of that byte are
+    # c, cc, ... up to run_max[c], so the longest match inside a run is found in one step
+    data = bytes(data)
+    n = len(data)
+    run_end = _run_ends(data)
+    clear, end = 1 << min_code_size, (1 << min_code_size) + 1
+    code_size, next_code = min_code_size + 1, end + 1
+    table = {}
+    get = table.get
+    run_codes = [[None, c] for c in range(256)]  # run_codes[c][m] is the code of c repeated m times
+    out = bytearray()
+    acc, acc_bits = 0, 0
+
+    acc |= clear << acc_bits
+    acc_bits += code_size
+    prefix = run_byte = data[0]
+    run_len = 1  # the current string is run_byte repeated run_len times, 0 when it isn't a run
+    i = 1
+    while i < n:
+        k = data[i]
+        if run_len and k == run_byte:
+            longest = min(run_len + run_end[i] - i, len(run_codes[k]) - 1)
+            if longest > run_len:
+                i += longest - run_len
+                prefix = run_codes[k][longest]
+                run_len = longest
+                continue
+        else:
+            key = prefix << 8 | k
+            code = get(key)
+            if code is not None:
+                prefix = code
+                run_len = 0
+                i += 1
+                continue
+
+        acc |= prefix << acc_bits
+        acc_bits += code_size
+        while acc_bits >= 8:
+            out.append(acc & 0xFF)
+            acc >>= 8
+            acc_bits -= 8
+        if next_code == 4096:
+            acc |= clear << acc_bits
+            acc_bits += code_size
+            table.clear()
+            run_codes = [[None, c] for c in range(256)]
+            code_size, next_code = min_code_size + 1, end + 1
+        else:
+            table[prefix << 8 | k] = next_code
+            if run_len and k == run_byte:
+                run_codes[k].append(next_code)
+            # the decoder adds its entries one code later, so it widens its codes once the next one doesn't fit
+            if next_code == 1 << code_size:
+                code_size += 1
+            next_code += 1
+        prefix = run_byte = k
+        run_len = 1
+        i += 1
+
+    for code in (prefix, end):
+        acc |= code << acc_bits
+        acc_bits += code_size
+    while acc_bits > 0:
+        out.append(acc & 0xFF)
+        acc >>= 8
+        acc_bits -= 8
+    return bytes(out)
+
+
+def write_gif(f, frames, delays):
+    # an endlessly looping GIF89a of palette index frames. each frame stores only the rectangle that changed,
+    # with the pixels that didn't change inside it transparent, which LZW packs as long runs
+    height, width = frames[0].shape
+    f.write(b"GIF89a" + struct.pack("<HHBBB", width, height, 0xF7, 0, 0))
+    f.write(bytes(c for color in GIF_PALETTE for c in color))
+    f.write(b"\x21\xFF\x0BNETSCAPE2.0\x03\x01\x00\x00\x00")
+
+    previous = None
+    for frame, delay in zip(frames, delays):
+        if previous is None:
+            top, left, bottom, right = 0, 0, height, width
+            data = frame
+        else:
+            changed = frame != previous
+            rows, cols = np.flatnonzero(changed.any(axis=1)), np.flatnonzero(changed.any(axis=0))
+            if len(rows):
+                top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+            else:
+                top, left, bottom, right = 0, 0, 1, 1
+            data = np.where(changed, frame, TRANSPARENT).astype(np.uint8)
+        transparent = previous is not None
+        previous = frame
+
+        # disposal 1 leaves the frame in place for the next one to draw over
+        f.write(struct.pack("<BBBBHBB", 0x21, 0xF9, 4, 1 << 2 | transparent, delay, TRANSPARENT, 0))
+        f.write(struct.pack("<BHHHHB", 0x2C, left, top, right - left, bottom - top, 0))
+        data = lzw_encode(np.ascontiguousarray(data[top:bottom, left:right]).tobytes())
+        f.write(b"\x08")
+        for i in range(0, len(data), 255):
+            block = data[i:i + 255]
+            f.write(bytes([len(block)]) + block)
+        f.write(b"\x00")
+    f.write(b"\x3B")
+
+
+# renderer of the current worker process
+_worker_renderer = None
+
+
+def _init_worker(size, theme):
+    global _worker_renderer
+    _worker_renderer = BoardRenderer(size, theme)
+
+
+def _export_game(task):
+    # writes the thumbnail (final position, last move highlighted) and optionally the animation of one game.
+    # a game that can't be replayed is skipped, with None for its number
+    number, game, out_dir, gif = task
+    try:
+        chess_board = game.start_board()
+        moves = list(game.play(chess_board))
+    except (ValueError, IndexError, KeyError) as e:
+        print(f"game {number} skipped: {e}", file=sys.stderr)
+        return None
+    name = os.path.join(out_dir, f"game_{number:05d}")
+    highlight = (moves[-1] & 63, moves[-1] >> 6 & 63) if moves else ()
+    _worker_renderer.save_png(chess_board, name + ".png", highlight)
+    if gif:
+        for _ in moves:
+            chess_board.reverse_move()
+        _worker_renderer.save_gif(moves, name + ".gif", chess_board)
+    return number
+
+
+def export_games(games, out_dir, size=240, theme=PIECE_TYPE, gif=False, processes=1):
+    # renders every pgn.PgnGame to out_dir, yielding the game numbers (from 1) as they are written.
+    # games with illegal or unreadable moves are skipped and reported on stderr
+    os.makedirs(out_dir, exist_ok=True)
+    tasks = ((number, game, out_dir, gif) for number, game in enumerate(games, 1))
+    if processes == 1:
+        _init_worker(size, theme)
+        for number in map(_export_game, tasks):
+            if number is not None:
+                yield number
+        return
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(size, theme)) as pool:
+        for number in pool.imap_unordered(_export_game, tasks):
+            if number is not None:
+                yield number
+
+
+def main():
+    parser = argparse.ArgumentParser(description="render the games of a PGN file to PNG thumbnails and GIFs")
+    parser.add_argument("pgn")
+    parser.add_argument("out_dir")
+    parser.add_argument("-s", "--size", type=int, default=240)
+    parser.add_argument("--theme", default=PIECE_TYPE)
+    parser.add_argument("--gif", action="store_true", help="also write an animation of every game")
+    parser.add_argument("-p", "--processes", type=int, default=1)
+    args = parser.parse_args()
+
+    from pgn import read_games
+
+    with open(args.pgn) as f:
+        count = sum(1 for _ in export_games(read_games(f), args.out_dir, args.size, args.theme, args.gif,
+                                            args.processes))
+    print(f"{count} games rendered to {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
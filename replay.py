@@ -0,0 +1,202 @@
+import argparse
+import time
+from array import array
+
+import pygame
+
+from chess_viz import ChessBoard, ChessViz, FPS, Move, PIECE_TYPE, SCREEN_SIZE, START_BOARD, THEMES
+
+
+CHECKPOINT_INTERVAL = 16
+MIN_SPEED, MAX_SPEED = 0.25, 64  # plies per second
+PAGE_PLIES = 10
+
+
+class GameLog:
+
+    # a game as its packed moves in an array of 16 bit ints plus a FEN checkpoint every interval plies,
+    # so any ply is rebuilt by playing fewer than interval moves from the checkpoint before it
+    def __init__(self, start_fen=None, interval=CHECKPOINT_INTERVAL):
+        self.interval = interval
+        self.moves = array("H")
+        self.checkpoints = [start_fen or ChessBoard(START_BOARD).fen()]
+        self.last = ChessBoard.from_fen(self.checkpoints[0])  # the position after the last move, for append
+
+    @classmethod
+    def from_moves(cls, moves, start_fen=None, interval=CHECKPOINT_INTERVAL):
+        log = cls(start_fen, interval)
+        for move in moves:
+            log.append(move)
+        return log
+
+    @classmethod
+    def from_pgn(cls, game, interval=CHECKPOINT_INTERVAL):
+        # a pgn.PgnGame
+        log = cls(game.start_board().fen(), interval)
+        for move in game.play():
+            log.append(move)
+        return log
+
+    def __len__(self):
+        return len(self.moves)
+
+    def append(self, move):
+        self.last.play_move(move)
+        self.moves.append(int(move))
+        if len(self.moves) % self.interval == 0:
+            # the undo history isn't needed past a checkpoint, the next one starts from a fresh board
+            fen = self.last.fen()
+            self.checkpoints.append(fen)
+            self.last = ChessBoard.from_fen(fen)
+
+    def move(self, ply):
+        # the move played at ply, leading to position ply + 1
+        return Move.from_code(self.moves[ply])
+
+    def position(self, ply):
+        # a new board at ply, able to step back to the checkpoint it was built from
+        ply = max(0, min(ply, len(self.moves)))
+        base = ply // self.interval
+        chess_board = ChessBoard.from_fen(self.checkpoints[base])
+        for code in self.moves[base * self.interval:ply]:
+            chess_board.play_move(code)
+        return chess_board
+
+
+class Replay:
+
+    # a cursor over a GameLog. short steps play or take back moves on the same board,
+    # longer jumps rebuild the board from the nearest checkpoint
+    def __init__(self, log: GameLog, ply=0):
+        self.log = log
+        self.ply = 0
+        self.base = 0  # the earliest ply self.board can step back to
+        self.board = log.position(0)
+        self.seek(ply)
+
+    def seek(self, ply):
+        ply = max(0, min(ply, len(self.log)))
+        if ply < self.base or abs(ply - self.ply) >= self.log.interval:
+            self.board = self.log.position(ply)
+            self.base = ply - ply % self.log.interval
+        else:
+            for p in range(self.ply, ply):
+                self.board.play_move(self.log.moves[p])
+            for _ in range(ply, self.ply):
+                self.board.reverse_move()
+        self.ply = ply
+        return self.board
+
+
+class ReplayViz(ChessViz):
+
+    # shows a GameLog. left / right step a ply, page up / down step PAGE_PLIES, home / end jump to the ends,
+    # space plays or pauses, up / down double or halve the speed, digits then enter jump to that ply, T cycles themes
+    def __init__(self, log: GameLog, ply=0, speed=2.0, theme=PIECE_TYPE):
+        super().__init__(START_BOARD, None, None, theme=theme)
+        self.replay = Replay(log, ply)
+        self.chess_board = self.replay.board
+        self.speed = speed  # plies per second
+        self.playing = False
+        self.next_step = 0
+        self.typed = ""  # digits of a ply to jump to
+
+    def seek(self, ply):
+        self.chess_board = self.replay.seek(ply)
+        # the last move's destination is highlighted
+        if self.replay.ply:
+            dst = self.replay.log.move(self.replay.ply - 1).dst
+            self.click_1 = (dst.i, dst.j)
+        else:
+            self.click_1 = None
+        if self.replay.ply == len(self.replay.log):
+            self.playing = False
+        self.update_caption()
+
+    def update_caption(self):
+        state = "playing" if self.playing else "paused"
+        jump = f", go to {self.typed}" if self.typed else ""
+        pygame.display.set_caption(f"Replay: ply {self.replay.ply} / {len(self.replay.log)}, "
+                                   f"{state} at {self.speed:g} plies/s{jump}")
+
+    def handle_key(self, key):
+        ply = self.replay.ply
+        if key == pygame.K_RIGHT:
+            self.seek(ply + 1)
+        elif key == pygame.K_LEFT:
+            self.seek(ply - 1)
+        elif key == pygame.K_PAGEDOWN:
+            self.seek(ply + PAGE_PLIES)
+        elif key == pygame.K_PAGEUP:
+            self.seek(ply - PAGE_PLIES)
+        elif key == pygame.K_HOME:
+            self.seek(0)
+        elif key == pygame.K_END:
+            self.seek(len(self.replay.log))
+        elif key == pygame.K_SPACE:
+            self.playing = not self.playing and ply < len(self.replay.log)
+            self.next_step = time.monotonic() + 1 / self.speed
+        elif key == pygame.K_UP:
+            self.speed = min(self.speed * 2, MAX_SPEED)
+        elif key == pygame.K_DOWN:
+            self.speed = max(self.speed / 2, MIN_SPEED)
+        elif pygame.K_0 <= key <= pygame.K_9:
+            self.typed += str(key - pygame.K_0)
+        elif key == pygame.K_BACKSPACE:
+            self.typed = self.typed[:-1]
+        elif key in (pygame.K_RETURN, pygame.K_KP_ENTER) and self.typed:
+            self.seek(int(self.typed))
+            self.typed = ""
+        elif key == pygame.K_t:
+            self.set_theme(THEMES[(THEMES.index(self.theme) + 1) % len(THEMES)])
+        self.update_caption()
+
+    def start_game(self):
+        pygame.init()
+        self.screen = pygame.display.set_mode(SCREEN_SIZE)
+        self.drawn = [None] * 64
+        self.seek(self.replay.ply)
+        self.draw_board()
+        pygame.display.update()
+        clock = pygame.time.Clock()
+
+        while True:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    exit(0)
+                elif event.type == pygame.VIDEOEXPOSE:
+                    self.drawn = [None] * 64
+                elif event.type == pygame.KEYDOWN:
+                    self.handle_key(event.key)
+
+            if self.playing and time.monotonic() >= self.next_step:
+                self.next_step += 1 / self.speed
+                self.seek(self.replay.ply + 1)
+
+            dirty = self.draw_board()
+            if dirty:
+                pygame.display.update(dirty)
+            clock.tick(FPS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay a game of a PGN file")
+    parser.add_argument("pgn")
+    parser.add_argument("-g", "--game", type=int, default=1, help="the game number in the file, from 1")
+    parser.add_argument("--ply", type=int, default=0, help="the ply to start at")
+    parser.add_argument("--speed", type=float, default=2.0, help="plies per second when playing")
+    args = parser.parse_args()
+
+    from pgn import read_games
+
+    with open(args.pgn) as f:
+        for number, game in enumerate(read_games(f), 1):
+            if number == args.game:
+                break
+        else:
+            parser.error(f"{args.pgn} has no game {args.game}")
+    ReplayViz(GameLog.from_pgn(game), args.ply, args.speed).start_game()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,481 @@
+import argparse
+import ctypes
+import multiprocessing
+import os
+import time
+
+from chess_viz import ChessBoard, Move, MoveType, Piece, Player, START_BOARD, TranspositionTable
+
+
+MATE = 100000
+INFINITY = 1 << 30
+MAX_PLY = 128
+
+# transposition table entry bounds
+EXACT, LOWER, UPPER = 0, 1, 2
+
+# the clock is read once every CHECK_NODES nodes
+CHECK_NODES = 512
+
+PIECE_VALUES = {Piece.Empty: 0, Piece.WP: 100, Piece.WN: 320, Piece.WB: 330, Piece.WR: 500, Piece.WQ: 900, Piece.WK: 0,
+                Piece.BP: 100, Piece.BN: 320, Piece.BB: 330, Piece.BR: 500, Piece.BQ: 900, Piece.BK: 0}
+
+# piece-square bonuses for white, rank 8 first as seen on a diagram
+PAWN_TABLE = [
+    0, 0, 0, 0, 0, 0, 0, 0,
+    50, 50, 50, 50, 50, 50, 50, 50,
+    10, 10, 20, 30, 30, 20, 10, 10,
+    5, 5, 10, 25, 25, 10, 5, 5,
+    0, 0, 0, 20, 20, 0, 0, 0,
+    5, -5, -10, 0, 0, -10, -5, 5,
+    5, 10, 10, -20, -20, 10, 10, 5,
+    0, 0, 0, 0, 0, 0, 0, 0,
+]
+KNIGHT_TABLE = [
+    -50, -40, -30, -30, -30, -30, -40, -50,
+    -40, -20, 0, 0, 0, 0, -20, -40,
+    -30, 0, 10, 15, 15, 10, 0, -30,
+    -30, 5, 15, 20, 20, 15, 5, -30,
+    -30, 0, 15, 20, 20, 15, 0, -30,
+    -30, 5, 10, 15, 15, 10, 5, -30,
+    -40, -20, 0, 5, 5, 0, -20, -40,
+    -50, -40, -30, -30, -30, -30, -40, -50,
+]
+BISHOP_TABLE = [
+    -20, -10, -10, -10, -10, -10, -10, -20,
+    -10, 0, 0, 0, 0, 0, 0, -10,
+    -10, 0, 5, 10, 10, 5, 0, -10,
+    -10, 5, 5, 10, 10, 5, 5, -10,
+    -10, 0, 10, 10, 10, 10, 0, -10,
+    -10, 10, 10, 10, 10, 10, 10, -10,
+    -10, 5, 0, 0, 0, 0, 5, -10,
+    -20, -10, -10, -10, -10, -10, -10, -20,
+]
+ROOK_TABLE = [
+    0, 0, 0, 0, 0, 0, 0, 0,
+    5, 10, 10, 10, 10, 10, 10, 5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    0, 0, 0, 5, 5, 0, 0, 0,
+]
+QUEEN_TABLE = [
+    -20, -10, -10, -5, -5, -10, -10, -20,
+    -10, 0, 0, 0, 0, 0, 0, -10,
+    -10, 0, 5, 5, 5, 5, 0, -10,
+    -5, 0, 5, 5, 5, 5, 0, -5,
+    0, 0, 5, 5, 5, 5, 0, -5,
+    -10, 5, 5, 5, 5, 5, 0, -10,
+    -10, 0, 5, 0, 0, 0, 0, -10,
+    -20, -10, -10, -5, -5, -10, -10, -20,
+]
+KING_TABLE = [
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -20, -30, -30, -40, -40, -30, -30, -20,
+    -10, -20, -20, -20, -20, -20, -20, -10,
+    20, 20, 0, 0, 0, 0, 20, 20,
+    20, 30, 10, 0, 0, 10, 30, 20,
+]
+PIECE_TABLES = {"P": PAWN_TABLE, "N": KNIGHT_TABLE, "B": BISHOP_TABLE, "R": ROOK_TABLE, "Q": QUEEN_TABLE, "K": KING_TABLE}
+
+
+def _square_scores():
+    # value + piece-square bonus of every piece on every square, by Piece.value, positive for white
+    res = [None] * 12
+    for piece in Piece:
+        if piece == Piece.Empty:
+            continue
+        table = PIECE_TABLES[piece.name[1]]
+        if piece.player().is_white():
+            # the diagram row of square i * 8 + j is 7 - i
+            res[piece.value] = [PIECE_VALUES[piece] + table[(7 - sq // 8) * 8 + sq % 8] for sq in range(64)]
+        else:
+            res[piece.value] = [-PIECE_VALUES[piece] - table[sq] for sq in range(64)]
+    return res
+
+
+SQUARE_SCORES = _square_scores()
+# the rank each player promotes on, by Player.value
+PROMOTION_RANKS = [0xFF, 0xFF << 56]
+PROMOTION_QUEEN = MoveType.PromotionQueen.value
+EN_PASSANT = MoveType.EnPassant.value
+
+
+def evaluate(chess_board: ChessBoard):
+    # material and piece placement in centipawns, from the view of the side to move
+    score = 0
+    for scores, bb in zip(SQUARE_SCORES, chess_board.bitboards):
+        while bb:
+            b = bb & -bb
+            score += scores[b.bit_length() - 1]
+            bb ^= b
+    return score if chess_board.turn.is_white() else -score
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class SearchPlayer:
+
+    # alpha-beta search with iterative deepening and quiescence, inside the calling process.
+    # can be used directly as player_white / player_black of ChessViz, a search never runs past its time budget
+    def __init__(self, think_time=1.0, max_depth=64, table_size=1 << 18, verbose=False):
+        self.think_time = think_time  # seconds per move when the caller gives no time_limit
+        self.max_depth = max_depth
+        self.verbose = verbose
+        self.table = TranspositionTable(table_size)  # (depth, score, bound, move code) by position hash
+
+        self.stopped = False
+        self.nodes = 0
+        self.deadline = None
+        self.killers = [[None, None] for _ in range(MAX_PLY)]
+        self.root_best = None
+        self.last_info = {}  # depth / score / nodes / nps / time of the last search, like UciEngine.last_info
+
+    def __call__(self, board, player: Player, time_limit=None):
+        # ChessViz and batch.py hand over a copy of their ChessBoard, an 8x8 list (older callers) is
+        # loaded with castling rights inferred from the home squares and no en passant square
+        if not isinstance(board, ChessBoard):
+            board = ChessBoard(board, player)
+        return self.search(board, self.think_time if time_limit is None else time_limit)
+
+    def stop(self):
+        # cut the current search short, it answers with the best move of the last finished depth
+        self.stopped = True
+
+    def new_game(self):
+        self.table.clear()
+
+    def search(self, chess_board: ChessBoard, time_limit=None, max_depth=None, first_depth=1) -> Move:
+        # the best move of the side to move found within time_limit seconds (no limit with None)
+        start = time.perf_counter()
+        self.deadline = None if time_limit is None else start + time_limit
+        self.stopped = False
+        self.nodes = 0
+        self.last_info = {}
+        for killers in self.killers:
+            killers[0] = killers[1] = None
+        max_depth = self.max_depth if max_depth is None else max_depth
+
+        codes = chess_board.legal_moves(chess_board.turn)
+        if not codes:
+            raise ValueError("no legal move")
+        best = codes[0]
+        history_size = len(chess_board.history)
+
+        for depth in range(first_depth, max_depth + 1):
+            self.root_best = None
+            try:
+                score = self._negamax(chess_board, depth, -INFINITY, INFINITY, 0)
+            except SearchTimeout:
+                while len(chess_board.history) > history_size:
+                    chess_board.reverse_move()
+                # the previous best move is searched first, a better one found before the timeout is kept
+                if self.root_best is not None:
+                    best = self.root_best
+                break
+            best = self.root_best
+
+            elapsed = time.perf_counter() - start
+            self._report(depth, score, elapsed, best)
+            # a single reply or a forced mate needs no deeper search, and the next depth wouldn't finish in time
+            if len(codes) == 1 or abs(score) >= MATE - MAX_PLY:
+                break
+            if self.deadline is not None and elapsed > time_limit / 2:
+                break
+
+        elapsed = time.perf_counter() - start
+        self.last_info["nodes"] = self.nodes
+        self.last_info["nps"] = int(self.nodes / max(elapsed, 1e-9))
+        self.last_info["time"] = int(elapsed * 1000)
+        return Move.from_code(best)
+
+    def _report(self, depth, score, elapsed, best):
+        if abs(score) >= MATE - MAX_PLY:
+            moves = (MATE - abs(score) + 1) // 2
+            score = ("mate", moves if score > 0 else -moves)
+        else:
+            score = ("cp", score)
+        self.last_info = {"depth": depth, "score": score, "nodes": self.nodes,
+                          "nps": int(self.nodes / max(elapsed, 1e-9)), "time": int(elapsed * 1000)}
+        if self.verbose:
+            print(f"info depth {depth} score {score[0]} {score[1]} nodes {self.nodes} nps {self.last_info['nps']} "
+                  f"time {self.last_info['time']} pv {Move.from_code(best).uci()}", flush=True)
+
+    def _tick(self):
+        self.nodes += 1
+        if self.nodes % CHECK_NODES == 0 and self._out_of_time():
+            raise SearchTimeout()
+
+    def _out_of_time(self):
+        return self.stopped or self.deadline is not None and time.perf_counter() >= self.deadline
+
+    def _negamax(self, chess_board: ChessBoard, depth, alpha, beta, ply):
+        if depth <= 0:
+            return self._quiesce(chess_board, alpha, beta, ply)
+        self._tick()
+        if ply and (chess_board.repetitions() > 1 or chess_board.halfmove_clock >= 100):
+            return 0
+
+        # mate scores are stored relative to the position, so they hold at any ply
+        key = chess_board.hash
+        entry = self.table.get(key)
+        table_move = None
+        if entry is not None:
+            entry_depth, score, bound, table_move = entry
+            if ply and entry_depth >= depth:
+                score = score - ply if score >= MATE - MAX_PLY else score + ply if score <= -MATE + MAX_PLY else score
+                if bound == EXACT or bound == LOWER and score >= beta or bound == UPPER and score <= alpha:
+                    return score
+
+        player = chess_board.turn
+        codes = chess_board.legal_moves(player)
+        if not codes:
+            return -MATE + ply if chess_board.is_checked(player) else 0
+
+        alpha_start = alpha
+        best, best_code = -INFINITY, None
+        for code in self._order(chess_board, codes, table_move, ply):
+            chess_board.play_move(code)
+            score = -self._negamax(chess_board, depth - 1, -beta, -alpha, ply + 1)
+            chess_board.reverse_move()
+
+            if score > best:
+                best, best_code = score, code
+                if ply == 0:
+                    self.root_best = code
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        # a quiet move that refutes the opponent's move is tried early at this ply in other lines
+                        if chess_board.squares[(code >> 6) & 63] == Piece.Empty and code != self.killers[ply][0]:
+                            self.killers[ply][1] = self.killers[ply][0]
+                            self.killers[ply][0] = code
+                        break
+
+        bound = UPPER if best <= alpha_start else LOWER if best >= beta else EXACT
+        stored = best + ply if best >= MATE - MAX_PLY else best - ply if best <= -MATE + MAX_PLY else best
+        self.table.put(key, (depth, stored, bound, best_code))
+        return best
+
+    def _quiesce(self, chess_board: ChessBoard, alpha, beta, ply):
+        # only captures and queen promotions are searched, so the evaluation isn't taken in the middle of an exchange
+        self._tick()
+        stand_pat = evaluate(chess_board)
+        if stand_pat >= beta or ply >= MAX_PLY - 1:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+
+        player = chess_board.turn
+        targets = chess_board.occupancy[1 - player.value] | PROMOTION_RANKS[player.value]
+        if chess_board.en_passant is not None:
+            targets |= 1 << chess_board.en_passant
+        squares = chess_board.squares
+        captures = [c for c in chess_board.legal_moves(player, to_mask=targets)
+                    if squares[(c >> 6) & 63] != Piece.Empty or c >> 12 in (PROMOTION_QUEEN, EN_PASSANT)]
+        for code in self._order(chess_board, captures, None, ply):
+            chess_board.play_move(code)
+            score = -self._quiesce(chess_board, -beta, -alpha, ply + 1)
+            chess_board.reverse_move()
+            if score > alpha:
+                alpha = score
+                if alpha >= beta:
+                    break
+        return alpha
+
+    def _order(self, chess_board: ChessBoard, codes, table_move, ply):
+        # table move, then captures by most valuable victim / least valuable attacker, promotions, killers, the rest
+        squares = chess_board.squares
+        killers = self.killers[ply]
+
+        def key(code):
+            if code == table_move:
+                return -100000
+            victim = squares[(code >> 6) & 63]
+            if victim != Piece.Empty:
+                return -10000 - 10 * PIECE_VALUES[victim] + PIECE_VALUES[squares[code & 63]] // 100
+            if code >> 12 == PROMOTION_QUEEN:
+                return -9000
+            if code == killers[0]:
+                return -8000
+            if code == killers[1]:
+                return -7000
+            return 0
+
+        return sorted(codes, key=key)
+
+
+class SharedTable:
+
+    # a transposition table in shared memory, for the worker processes of a ParallelSearchPlayer.
+    # slot i holds key ^ data and data with the entry packed into data, so a slot torn by two
+    # processes writing at once fails the key check instead of handing out a wrong entry
+    def __init__(self, size=1 << 20):
+        self.size = size
+        self.slots = multiprocessing.RawArray("Q", 2 * size)
+        self.stop_flag = multiprocessing.RawValue("b", 0)  # set to stop the searches of every worker
+        self.hits = 0
+        self.misses = 0
+        self.words = memoryview(self.slots).cast("B").cast("Q")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["words"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.words = memoryview(self.slots).cast("B").cast("Q")
+
+    def get(self, key):
+        i = key % self.size * 2
+        data = self.words[i + 1]
+        if self.words[i] ^ data != key:
+            self.misses += 1
+            return None
+        self.hits += 1
+        move = data >> 48
+        return (data >> 32) & 0xFF, (data & 0xFFFFFFFF) - (1 << 31), (data >> 40) & 3, move - 1 if move else None
+
+    def put(self, key, entry):
+        # (depth, score, bound, move code or None), the newest entry of a slot wins
+        depth, score, bound, move = entry
+        data = (score + (1 << 31)) | min(depth, 0xFF) << 32 | bound << 40 | (0 if move is None else move + 1) << 48
+        i = key % self.size * 2
+        self.words[i] = key ^ data
+        self.words[i + 1] = data
+        return entry
+
+    def clear(self):
+        ctypes.memset(self.slots, 0, ctypes.sizeof(self.slots))
+
+
+class _WorkerSearch(SearchPlayer):
+
+    # the search of a ParallelSearchPlayer worker, also stopped through the shared stop flag
+    def _out_of_time(self):
+        return self.table.stop_flag.value or super()._out_of_time()
+
+
+# search of the current worker process, set up once with the shared table
+_worker_search = None
+
+
+def _init_search_worker(table, max_depth):
+    global _worker_search
+    _worker_search = _WorkerSearch(max_depth=max_depth)
+    _worker_search.table = table
+
+
+def _search_position(fen, time_limit, max_depth, first_depth):
+    move = _worker_search.search(ChessBoard.from_fen(fen), time_limit, max_depth, first_depth)
+    info = _worker_search.last_info
+    return info.get("depth", 0), info.get("score"), int(move), info["nodes"]
+
+
+class ParallelSearchPlayer:
+
+    # Lazy SMP: every worker process searches the same position, sharing one SharedTable, so each finds
+    # the entries the others stored. half the workers start one depth deeper to spread them out, the first
+    # worker decides when to stop and the deepest finished search gives the move.
+    # can be used as player_white / player_black of ChessViz, not inside batch.py workers (they can't fork)
+    def __init__(self, think_time=1.0, processes=None, max_depth=64, table_size=1 << 20, verbose=False):
+        self.think_time = think_time
+        self.processes = processes or os.cpu_count() or 1
+        self.max_depth = max_depth
+        self.table_size = table_size
+        self.verbose = verbose
+
+        self.pool = None
+        self.table = None
+        self.last_info = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getstate__(self):
+        # a copy sent to another process starts its own pool on first use
+        state = self.__dict__.copy()
+        state["pool"] = None
+        state["table"] = None
+        return state
+
+    def __call__(self, board, player: Player, time_limit=None):
+        if not isinstance(board, ChessBoard):
+            board = ChessBoard(board, player)
+        return self.search(board, self.think_time if time_limit is None else time_limit)
+
+    def start(self):
+        self.table = SharedTable(self.table_size)
+        self.pool = multiprocessing.Pool(self.processes, initializer=_init_search_worker,
+                                         initargs=(self.table, self.max_depth))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def stop(self):
+        if self.table is not None:
+            self.table.stop_flag.value = 1
+
+    def new_game(self):
+        if self.table is not None:
+            self.table.clear()
+
+    def search(self, chess_board: ChessBoard, time_limit=None, max_depth=None) -> Move:
+        if self.pool is None:
+            self.start()
+        start = time.perf_counter()
+        self.table.stop_flag.value = 0
+        fen = chess_board.fen()
+        jobs = [self.pool.apply_async(_search_position, (fen, time_limit, max_depth, 1 + i % 2))
+                for i in range(self.processes)]
+
+        results = [jobs[0].get()]
+        self.table.stop_flag.value = 1
+        results.extend(job.get() for job in jobs[1:])
+        elapsed = time.perf_counter() - start
+
+        depth, score, code, _ = max(results, key=lambda r: r[0])
+        nodes = sum(r[3] for r in results)
+        self.last_info = {"depth": depth, "score": score, "nodes": nodes, "nps": int(nodes / max(elapsed, 1e-9)),
+                          "time": int(elapsed * 1000)}
+        if self.verbose and score is not None:
+            print(f"info depth {depth} score {score[0]} {score[1]} nodes {nodes} nps {self.last_info['nps']} "
+                  f"time {self.last_info['time']} pv {Move.from_code(code).uci()}", flush=True)
+        return Move.from_code(code)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="search a position and report depth, score and nodes per second")
+    parser.add_argument("--fen", help="the position to search, the start position by default")
+    parser.add_argument("-t", "--time", type=float, default=5.0, help="seconds to search")
+    parser.add_argument("-d", "--depth", type=int, default=64)
+    parser.add_argument("-p", "--processes", type=int, default=1, help="worker processes of a Lazy SMP search")
+    args = parser.parse_args()
+
+    chess_board = ChessBoard(START_BOARD) if args.fen is None else ChessBoard.from_fen(args.fen)
+    if args.processes > 1:
+        with ParallelSearchPlayer(processes=args.processes, max_depth=args.depth, verbose=True) as player:
+            move = player.search(chess_board, args.time)
+    else:
+        player = SearchPlayer(max_depth=args.depth, verbose=True)
+        move = player.search(chess_board, args.time)
+    info = player.last_info
+    print(f"bestmove {move.uci()}  ({info['nodes']} nodes in {info['time']} ms, {info['nps']} nps)")
+
+
+if __name__ == "__main__":
+    main()
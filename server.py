@@ -0,0 +1,326 @@
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import multiprocessing
+
+from batch import MAX_PLIES, make_player
+from chess_viz import ChessBoard, Move, Player, START_BOARD, takes_time_limit
+
+
+# many games on one asyncio event loop, played over a line protocol on localhost. one command per line,
+# words separated by spaces, a FEN always comes last:
+#
+#   NEW <white> <black> [fen]  a game, each side "human" (this connection plays it), "open" (left for a JOIN)
+#                              or a bot as for batch.py ("random", "search:0.2", "uci:<engine command>")
+#   JOIN <id> <white|black>    takes the open seat of a game
+#   WATCH <id>                 subscribes to the game's events without playing
+#   MOVE <id> <move>           plays a move in coordinate notation (e2e4, e7e8q) for a seat of this connection
+#   MOVES <id>                 the legal moves of the side to move
+#   FEN <id>                   the position
+#   RESIGN <id>                resigns the side (or both sides) this connection plays
+#   LIST                       the ids of the running games
+#   QUIT
+#
+# replies are "GAME <id> <fen>", "MOVES <id> ...", "FEN <id> <fen>", "GAMES ...", "OK" or "ERROR <message>".
+# everyone seated at or watching a game gets "MOVED <id> <move> <fen>" after each move and
+# "OVER <id> <result> <reason>" when it ends. a game is dropped once it is over, and the games of a
+# connection that closes are forfeited by the side it played (or aborted when it only created them).
+
+HOST, PORT = "127.0.0.1", 8765
+HUMAN, OPEN = "human", "open"
+MAX_GAMES = 1000
+MAX_LINE = 4096
+GAME_COMMANDS = ("JOIN", "WATCH", "MOVE", "MOVES", "FEN", "RESIGN")
+
+
+# players of the current worker process by spec, so an engine stays open for every game it plays
+_worker_players = None
+
+
+def _init_worker():
+    global _worker_players
+    _worker_players = {}
+
+
+def _bot_move(spec, fen, time_limit):
+    player_fn = _worker_players.get(spec)
+    if player_fn is None:
+        player_fn = _worker_players[spec] = make_player(spec)
+    chess_board = ChessBoard.from_fen(fen)
+    kwargs = {"time_limit": time_limit} if time_limit is not None and takes_time_limit(player_fn) else {}
+    return player_fn(chess_board, chess_board.turn, **kwargs).uci()
+
+
+class EnginePool:
+
+    # bot moves of every game on a few worker processes. a worker keeps one player per spec and it serves
+    # all the games of that spec, so per game state (scripts, new_game) isn't kept apart
+    def __init__(self, processes=None, think_time=None):
+        self.think_time = think_time
+        # spawned rather than forked: a forked worker would keep the client sockets open past a disconnect
+        context = multiprocessing.get_context("spawn")
+        self.executor = concurrent.futures.ProcessPoolExecutor(processes, context, _init_worker)
+
+    async def move(self, spec, fen):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, _bot_move, spec, fen, self.think_time)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class Session:
+
+    # one client connection
+    def __init__(self, writer):
+        self.writer = writer
+        self.games = set()  # ids of the games it created, plays or watches
+
+    def send(self, line):
+        if not self.writer.is_closing():
+            self.writer.write(line.encode() + b"\n")
+
+
+class Game:
+
+    def __init__(self, game_id, chess_board: ChessBoard, owner: Session, sides):
+        self.id = game_id
+        self.chess_board = chess_board
+        self.owner = owner
+        self.bots = {}  # bot spec by Player
+        self.seats = {}  # human seats by Player, the Session playing it or None while open
+        for player, side in zip((Player.White, Player.Black), sides):
+            if side == HUMAN:
+                self.seats[player] = owner
+            elif side == OPEN:
+                self.seats[player] = None
+            else:
+                self.bots[player] = side
+        self.watchers = {owner}
+        self.plies = 0
+        self.task = None  # the asyncio task playing the bot moves
+
+    def broadcast(self, line):
+        for session in self.watchers:
+            session.send(line)
+
+    def outcome(self, max_plies):
+        # (result, reason) once the game is over, None before
+        chess_board = self.chess_board
+        turn = chess_board.turn
+        if not chess_board.legal_moves(turn):
+            if chess_board.is_checked(turn):
+                return ("0-1" if turn.is_white() else "1-0"), "checkmate"
+            return "1/2-1/2", "stalemate"
+        if chess_board.is_threefold_repetition():
+            return "1/2-1/2", "threefold repetition"
+        if self.plies >= max_plies:
+            return "1/2-1/2", "move limit"
+        return None
+
+
+def _loss(player: Player):
+    return "0-1" if player.is_white() else "1-0"
+
+
+class GameServer:
+
+    def __init__(self, pool: EnginePool, max_games=MAX_GAMES, max_plies=MAX_PLIES):
+        self.pool = pool
+        self.max_games = max_games
+        self.max_plies = max_plies
+        self.games = {}
+        self.ids = itertools.count(1)
+
+    async def serve(self, host=HOST, port=PORT):
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_LINE)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        session = Session(writer)
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:  # longer than MAX_LINE
+                    session.send("ERROR line too long")
+                    break
+                if not line:
+                    break
+                words = line.decode(errors="replace").split()
+                if not words:
+                    continue
+                if words[0].upper() == "QUIT":
+                    session.send("OK")
+                    break
+                try:
+                    session.send(self.dispatch(session, words[0].upper(), words[1:]))
+                except ValueError as e:
+                    session.send(f"ERROR {e}")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.close_session(session)
+            writer.close()
+
+    def dispatch(self, session: Session, command, args):
+        if command == "NEW":
+            return self.new_game(session, args)
+        if command == "LIST":
+            return " ".join(["GAMES"] + [str(game_id) for game_id in self.games])
+        if command not in GAME_COMMANDS:
+            raise ValueError(f"unknown command {command}")
+        if not args:
+            raise ValueError(f"{command} needs a game id")
+        game = self.game(args[0])
+        if command == "JOIN":
+            return self.join(session, game, args[1:])
+        if command == "WATCH":
+            game.watchers.add(session)
+            session.games.add(game.id)
+            return "OK"
+        if command == "MOVE":
+            if len(args) != 2:
+                raise ValueError("MOVE needs a game id and a move")
+            self.human_move(session, game, args[1])
+            return "OK"
+        if command == "MOVES":
+            chess_board = game.chess_board
+            codes = chess_board.legal_moves(chess_board.turn)
+            return " ".join([f"MOVES {game.id}"] + [Move.from_code(c).uci() for c in codes])
+        if command == "FEN":
+            return f"FEN {game.id} {game.chess_board.fen()}"
+        if command == "RESIGN":
+            players = [p for p, s in game.seats.items() if s is session]
+            if not players:
+                raise ValueError(f"no seat in game {game.id}")
+            self.finish(game, _loss(players[0]) if len(players) == 1 else "*", "resignation")
+            return "OK"
+
+    def game(self, text):
+        try:
+            return self.games[int(text)]
+        except (ValueError, KeyError):
+            raise ValueError(f"no game {text}") from None
+
+    def new_game(self, session: Session, args):
+        if len(args) < 2:
+            raise ValueError("NEW needs a white and a black side")
+        if len(self.games) >= self.max_games:
+            raise ValueError("too many games")
+        sides = args[:2]
+        for side in sides:
+            if side not in (HUMAN, OPEN):
+                make_player(side)  # raises ValueError for an unknown spec
+        try:
+            chess_board = ChessBoard.from_fen(" ".join(args[2:])) if len(args) > 2 else ChessBoard(START_BOARD)
+        except (ValueError, IndexError, KeyError):
+            raise ValueError("bad FEN") from None
+
+        game = Game(next(self.ids), chess_board, session, sides)
+        self.games[game.id] = game
+        session.games.add(game.id)
+        # a bot's first move (or the end of a game set up as over) comes after this reply
+        asyncio.get_running_loop().call_soon(self.next_turn, game)
+        return f"GAME {game.id} {chess_board.fen()}"
+
+    def join(self, session: Session, game: Game, args):
+        if not args or args[0].lower() not in ("white", "black"):
+            raise ValueError("JOIN needs a game id and white or black")
+        player = Player.White if args[0].lower() == "white" else Player.Black
+        if player not in game.seats or game.seats[player] is not None:
+            raise ValueError(f"{args[0].lower()} isn't open in game {game.id}")
+        game.seats[player] = session
+        game.watchers.add(session)
+        session.games.add(game.id)
+        return f"GAME {game.id} {game.chess_board.fen()}"
+
+    def human_move(self, session: Session, game: Game, text):
+        turn = game.chess_board.turn
+        if game.seats.get(turn) is not session:
+            raise ValueError(f"not your turn in game {game.id}")
+        move = game.chess_board.move_from_uci(text)  # ValueError for an illegal move
+        self.play(game, move)
+
+    def play(self, game: Game, move):
+        game.chess_board.play_move(move)
+        game.plies += 1
+        game.broadcast(f"MOVED {game.id} {move.uci()} {game.chess_board.fen()}")
+        self.next_turn(game)
+
+    def next_turn(self, game: Game):
+        outcome = game.outcome(self.max_plies)
+        if outcome is not None:
+            self.finish(game, *outcome)
+        elif game.chess_board.turn in game.bots and game.task is None:
+            game.task = asyncio.get_running_loop().create_task(self.play_bots(game))
+
+    async def play_bots(self, game: Game):
+        # the bot moves of a game, one at a time on the pool, until a human is to move
+        chess_board = game.chess_board
+        try:
+            while game.id in self.games and chess_board.turn in game.bots:
+                turn = chess_board.turn
+                try:
+                    move = chess_board.move_from_uci(await self.pool.move(game.bots[turn], chess_board.fen()))
+                except Exception:  # an illegal move, or the bot failed
+                    self.finish(game, _loss(turn), "illegal move")
+                    return
+                self.play(game, move)
+        finally:
+            game.task = None
+
+    def finish(self, game: Game, result, reason):
+        if self.games.pop(game.id, None) is None:
+            return
+        if game.task is not None and game.task is not asyncio.current_task():
+            game.task.cancel()
+        game.broadcast(f"OVER {game.id} {result} {reason}")
+        for session in game.watchers | set(game.seats.values()):
+            if session is not None:
+                session.games.discard(game.id)
+
+    def close_session(self, session: Session):
+        # the side a closed connection played loses. games it created without anyone seated are aborted,
+        # the others go on without it
+        for game_id in list(session.games):
+            game = self.games.get(game_id)
+            if game is None:
+                continue
+            game.watchers.discard(session)
+            players = [p for p, s in game.seats.items() if s is session]
+            if len(players) == 1:
+                self.finish(game, _loss(players[0]), "abandoned")
+            elif players:
+                self.finish(game, "*", "abandoned")
+            elif game.owner is session and not any(game.seats.values()):
+                self.finish(game, "*", "aborted")
+        session.games.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="host many games on localhost over a line protocol")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("-p", "--processes", type=int, default=None, help="engine processes, defaults to the core count")
+    parser.add_argument("--think-time", type=float, default=None, help="seconds per bot move")
+    parser.add_argument("--max-games", type=int, default=MAX_GAMES)
+    parser.add_argument("--max-plies", type=int, default=MAX_PLIES)
+    args = parser.parse_args()
+
+    pool = EnginePool(args.processes, args.think_time)
+    server = GameServer(pool, args.max_games, args.max_plies)
+    print(f"serving on {args.host}:{args.port}")
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()